@@ -1,25 +1,137 @@
 # Django
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.translation import ugettext_lazy as _
 
 # This app
-from notification.models import NoticeType, NoticeSetting, Observation, NoticeQueueBatch
+from notification.models import (NoticeType, NoticeSetting, MediumMute, Observation,
+                                 NoticeQueueBatch, Delivery)
 #FIXME dinamically import classes of the type ModelAdmin and register them here
-from notification.backends.website import Notice
+from notification.backends.website import Notice, SEEN_WATERMARK
+from notification.retention import delete_ids
+
+# Unfiltered changelists of tables with more rows than this show the row
+# count estimated by the database instead of counting them.
+ESTIMATE_COUNT_ABOVE = 100000
+
+
+def estimated_count(queryset):
+    '''
+    Returns the database's estimate of the number of rows in the table of
+    queryset, or None when the database does not keep one.
+    '''
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [table])
+        row = cursor.fetchone()
+        return int(row[0]) if row else None
+    if connection.vendor == 'mysql':
+        cursor.execute("SHOW TABLE STATUS LIKE %s", [table])
+        row = cursor.fetchone()
+        return int(row[4]) if row and row[4] is not None else None
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Uses the database's row estimate for unfiltered querysets of big tables.
+    '''
+
+    def _get_count(self):
+        if self._count is None and not self.object_list.query.where:
+            estimate = estimated_count(self.object_list)
+            if estimate is not None and estimate > ESTIMATE_COUNT_ABOVE:
+                self._count = estimate
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
 
 class NoticeTypeAdmin(admin.ModelAdmin):
-    list_display = ["label", "display", "description", "default"]
+    list_display = ["label", "display", "description", "default", "priority"]
 
 class NoticeSettingAdmin(admin.ModelAdmin):
     list_display = ["id", "user", "notice_type", "medium", "send"]
-    
+    list_filter = ["notice_type", "medium"]
+    list_select_related = True
+    raw_id_fields = ["user"]
+    paginator = EstimatedCountPaginator
+
+class MediumMuteAdmin(admin.ModelAdmin):
+    list_display = ["id", "user", "medium", "added"]
+    list_filter = ["medium"]
+    list_select_related = True
+    raw_id_fields = ["user"]
+
 class NoticeAdmin(admin.ModelAdmin):
-    list_display = ["id", "recipient", "sender", "notice_type", "data", "added", "unseen", "archived"]
+    # data is left out, it would be unpickled for every row
+    list_display = ["id", "recipient", "sender", "notice_type", "added", "unseen", "archived"]
+    list_filter = ["notice_type", "added"]
+    raw_id_fields = ["recipient", "payload"]
+    paginator = EstimatedCountPaginator
+    actions = ["mark_seen", "mark_unseen", "archive", "delete_notices"]
+
+    def queryset(self, request):
+        qs = super(NoticeAdmin, self).queryset(request)
+        return (qs.select_related("recipient", "notice_type")
+                  .prefetch_related("sender")
+                  .defer("data"))
+
+    def mark_seen(self, request, queryset):
+        count = queryset.update(unseen=False, keep_unseen=False)
+        self.message_user(request, _("%d notices marked as seen.") % count)
+    mark_seen.short_description = _("Mark selected notices as seen")
+
+    def mark_unseen(self, request, queryset):
+        count = queryset.update(unseen=True, keep_unseen=SEEN_WATERMARK)
+        self.message_user(request, _("%d notices marked as unseen.") % count)
+    mark_unseen.short_description = _("Mark selected notices as unseen")
+
+    def archive(self, request, queryset):
+        count = queryset.update(archived=True)
+        self.message_user(request, _("%d notices archived.") % count)
+    archive.short_description = _("Archive selected notices")
+
+    def delete_notices(self, request, queryset):
+        ids = list(queryset.values_list("id", flat=True))
+        delete_ids(Notice, ids, queryset.db)
+        self.message_user(request, _("%d notices deleted.") % len(ids))
+    delete_notices.short_description = _("Delete selected notices at once")
 
 class ObservationAdmin(admin.ModelAdmin):
     list_display = ["id", "content_type", "object_id", "observed_object", "user", "notice_type"]
+    list_filter = ["notice_type", "content_type"]
+    raw_id_fields = ["user"]
+    paginator = EstimatedCountPaginator
+    actions = ["stop_sending", "resume_sending"]
+
+    def queryset(self, request):
+        qs = super(ObservationAdmin, self).queryset(request)
+        return (qs.select_related("user", "notice_type", "content_type")
+                  .prefetch_related("observed_object"))
+
+    def stop_sending(self, request, queryset):
+        count = queryset.update(send=False)
+        self.message_user(request, _("%d observations will not send notices.") % count)
+    stop_sending.short_description = _("Stop sending notices for selected observations")
+
+    def resume_sending(self, request, queryset):
+        count = queryset.update(send=True)
+        self.message_user(request, _("%d observations will send notices.") % count)
+    resume_sending.short_description = _("Send notices for selected observations")
+
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = ["id", "recipient", "notice_type", "medium", "priority", "status", "attempts", "due", "sent"]
+    list_filter = ["status", "medium"]
+    list_select_related = True
+    paginator = EstimatedCountPaginator
 
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
+admin.site.register(MediumMute, MediumMuteAdmin)
 admin.site.register(Notice, NoticeAdmin)
 admin.site.register(Observation, ObservationAdmin)
 admin.site.register(NoticeQueueBatch)
+admin.site.register(Delivery, DeliveryAdmin)
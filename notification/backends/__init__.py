@@ -5,8 +5,171 @@ from django.core import exceptions
 
 from base import BaseBackend
 
-from django.template.loader import render_to_string
+from django.template.loader import select_template
 from django.template import Context
+from django.template.base import Node, NodeList, Variable, Token, TOKEN_VAR
+from django.utils.encoding import force_text
+from django.utils.safestring import mark_safe
+
+# Render the parts of a notification that do not depend on the recipient once
+# per send, see PrerenderedTemplate.
+SHARED_RENDERING = getattr(settings, "NOTIFICATION_SHARED_RENDERING", False)
+
+# Context keys whose values change from one recipient to the next within a
+# single send.  A template that references none of them renders the same for
+# every recipient of that send.
+RECIPIENT_CONTEXT_KEYS = frozenset(["recipient", "unsubscribe_link",
+                                    "sender_url", "notice_id", "added",
+                                    "unseen", "archived", "count"])
+
+# Context key holding the per send (and per language) fragment cache.  Names
+# starting with an underscore can not be looked up from templates.
+FRAGMENTS_KEY = "_fragments"
+
+
+class OpaqueTemplate(Exception):
+    pass
+
+
+def _collect_names(obj, names, seen):
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, Variable):
+        if obj.lookups:
+            names.add(obj.lookups[0])
+    elif isinstance(obj, Token):
+        if obj.token_type == TOKEN_VAR:
+            names.add(obj.contents.split(".")[0])
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _collect_names(item, names, seen)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            _collect_names(item, names, seen)
+    elif isinstance(obj, Node) or type(obj).__module__.startswith("django.template"):
+        # Nodes that see the whole context (inclusion tags with
+        # takes_context, {% include %}, {% extends %}) can not be analysed.
+        if (getattr(obj, "takes_context", False) or
+                type(obj).__name__ in ("IncludeNode", "ConstantIncludeNode",
+                                       "ExtendsNode", "BlockNode")):
+            raise OpaqueTemplate
+        for value in vars(obj).values():
+            _collect_names(value, names, seen)
+
+
+def referenced_names(nodes):
+    '''
+    Returns the set of root context names referenced by a node or a list of
+    nodes, or None when that can not be determined.
+    '''
+    names = set()
+    try:
+        _collect_names(nodes, names, set())
+    except OpaqueTemplate:
+        return None
+    return names
+
+
+def depends_on_recipient(nodes, dependent=RECIPIENT_CONTEXT_KEYS):
+    names = referenced_names(nodes)
+    return names is None or bool(names & dependent)
+
+
+def assigned_names(node):
+    '''
+    Returns the context names set by a node or any node nested in it
+    ({% url ... as name %}, assignment tags, ...).
+    '''
+    names = set()
+    for child in node.get_nodes_by_type(Node):
+        for attr in ("target_var", "asvar", "variable_name"):
+            name = getattr(child, attr, None)
+            if isinstance(name, basestring):
+                names.add(name)
+    return names
+
+
+def get_notification_template(template, label):
+    return select_template(("notification/%s/%s" % (label, template),
+                            "notification/default/%s" % template))
+
+
+class PrerenderedTemplate(object):
+    '''
+    A template rendered once with the context of the first recipient of a
+    send. Parts that depend on the recipient are kept as nodes and rendered
+    again for every recipient, everything else is reused as rendered text.
+
+    With split=False the template is either reused as a whole or rendered
+    from scratch for every recipient. With split=True every top level node is
+    looked at on its own.
+    '''
+    def __init__(self, template, context, autoescape=True, dependent=(),
+                 split=False):
+        self.template = template
+        self.context = Context(context, autoescape=autoescape)
+        dependent = set(RECIPIENT_CONTEXT_KEYS).union(dependent)
+        nodes = list(template.nodelist) if split else [template.nodelist]
+        self.parts = []
+        self.context.render_context.push()
+        try:
+            for node in nodes:
+                if depends_on_recipient(node, dependent):
+                    if split:
+                        # whatever this node sets now differs per recipient
+                        dependent.update(assigned_names(node))
+                    self.parts.append(node)
+                else:
+                    self.parts.append(self.render_node(node, self.context))
+        finally:
+            self.context.render_context.pop()
+        self.shared = not any(isinstance(part, (Node, NodeList))
+                              for part in self.parts)
+
+    def render_node(self, node, context):
+        if isinstance(node, NodeList):
+            return node.render(context)
+        return self.template.nodelist.render_node(node, context)
+
+    def render(self, context):
+        if self.shared:
+            return mark_safe(u"".join(self.parts))
+        self.context.update(context)
+        self.context.render_context.push()
+        try:
+            bits = []
+            for part in self.parts:
+                if isinstance(part, (Node, NodeList)):
+                    part = self.render_node(part, self.context)
+                bits.append(force_text(part))
+            return mark_safe(u"".join(bits))
+        finally:
+            self.context.render_context.pop()
+            self.context.pop()
+
+
+def render_fragment(template_names, context, autoescape=True, dependent=()):
+    '''
+    Renders the first template found in template_names with context.
+
+    When the context carries a fragment cache (see send_now) the template is
+    only compiled and rendered in full once per send and language, later
+    recipients only render what depends on them. dependent lists extra
+    context names that differ from one recipient to the next.
+    '''
+    fragments = context.get(FRAGMENTS_KEY, None)
+    if fragments is None:
+        return select_template(template_names).render(
+                        Context(context, autoescape=autoescape))
+
+    key = tuple(template_names)
+    if key not in fragments:
+        fragments[key] = PrerenderedTemplate(select_template(template_names),
+                                             context, autoescape, dependent,
+                                             split=SHARED_RENDERING)
+    return fragments[key].render(context)
+
 
 def format_notification(template, label, context):
     '''
@@ -14,10 +177,9 @@ def format_notification(template, label, context):
     '''
     # conditionally turn off autoescaping for .txt extensions in format
     autoescape = not template.endswith(".txt")
-    return render_to_string(("notification/%s/%s" % (label, template),
-                             "notification/default/%s" % template),
-                            context_instance=Context(context,
-                                autoescape=autoescape))
+    return render_fragment(("notification/%s/%s" % (label, template),
+                            "notification/default/%s" % template),
+                           context, autoescape)
 
 # mostly for backend compatibility
 default_backends = (
@@ -47,5 +209,6 @@ def load_backends():
         # add the backend label and an instantiated backend class to the
         # backends list.
         backend_instance = getattr(mod, backend_class)(medium_id, spam_sensitivity)
+        backend_instance.label = label
         backends.append(((medium_id, label), backend_instance))
     return dict(backends)
@@ -0,0 +1,162 @@
+# Python Core
+from datetime import timedelta
+
+# Django
+from django.db import models, router
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signing import Signer
+from django.core.urlresolvers import reverse
+from django.template.loader import render_to_string
+from django.template import Context
+from django.utils import timezone
+from django.utils.translation import get_language, activate, ugettext_lazy as _
+
+# This app
+from notification import backends
+from notification.models import NoticeType
+
+# A user's digest is sent once their oldest pending notice is this old.
+DIGEST_INTERVAL = timedelta(minutes=getattr(settings, "NOTIFICATION_DIGEST_INTERVAL", 60 * 24))
+DIGEST_CHUNK_SIZE = getattr(settings, "NOTIFICATION_DIGEST_CHUNK_SIZE", 500)
+
+
+class DigestNotice(models.Model):
+    '''
+    An email notice waiting to be sent with the recipient's next digest. The
+    messages are rendered at delivery time, in the recipient's language.
+    '''
+    recipient = models.ForeignKey(User, verbose_name=_("recipient"))
+    notice_type = models.ForeignKey(NoticeType, verbose_name=_("notice type"))
+    added = models.DateTimeField(_("added"), auto_now_add=True, db_index=True)
+    subject = models.TextField(_("subject"))
+    message_txt = models.TextField(_("text message"))
+    message_html = models.TextField(_("html message"))
+
+    def __unicode__(self):
+        return self.subject
+
+    class Meta:
+        app_label = 'notification'  # needed for syncdb
+        ordering = ["added"]
+        verbose_name = _("digest notice")
+        verbose_name_plural = _("digest notices")
+
+
+class DigestBackend(backends.BaseBackend):
+    """
+    Collects email notices and sends them as one combined email per user, see
+    send_digests. Users who pick the digest for a notice type get no
+    immediate email for it, see EmailBackend.digests.
+    """
+    # opt-in: no notice type is collected into the digest by default
+    spam_sensitivity = None
+
+    def can_send(self, user, notice_type):
+        can_send = super(DigestBackend, self).can_send(user, notice_type)
+        if can_send and user.email:
+            return True
+        return False
+
+    def deliver(self, recipient, sender, notice_type, extra_context):
+        subject = backends.format_notification("short.txt",
+                                               notice_type.label,
+                                               extra_context).rstrip('\n').rstrip('\r')
+        message_txt = backends.format_notification("full.txt",
+                                                   notice_type.label,
+                                                   extra_context)
+        message_html = backends.format_notification("full.html",
+                                                    notice_type.label,
+                                                    extra_context)
+        DigestNotice.objects.create(recipient=recipient,
+                                    notice_type=notice_type,
+                                    subject=subject,
+                                    message_txt=message_txt,
+                                    message_html=message_html)
+
+
+def render_digest(user, notices):
+    '''
+    Returns the digest email for a user and their pending DigestNotices.
+    '''
+    from notification.models import root_url, current_site
+    signer = Signer()
+    args = ['digest', signer.sign(user.pk)]
+    context = Context({
+        "recipient": user,
+        "notices": notices,
+        "notices_url": root_url + reverse("notification_notices"),
+        "root_url": root_url,
+        "current_site": current_site,
+        "unsubscribe_link": root_url + reverse('notificaton_unsubscribe', args=args),
+    })
+    body = render_to_string(("notification/digest_body.html",
+                             "notification/default/digest_body.html"),
+                            {}, context)
+    context.autoescape = False
+    subject = render_to_string(("notification/digest_subject.txt",
+                                "notification/default/digest_subject.txt"),
+                               {}, context).strip()
+    body_txt = render_to_string(("notification/digest_body.txt",
+                                 "notification/default/digest_body.txt"),
+                                {}, context)
+    msg = EmailMultiAlternatives(subject, body_txt,
+            settings.DEFAULT_FROM_EMAIL, [user.email])
+    msg.attach_alternative(body, "text/html")
+    return msg
+
+
+def send_digest_chunk(user_ids):
+    '''
+    Sends the digests of the given users with one query for their pending
+    notices, and removes the notices that were sent.
+    '''
+    from notification.models import group_by_language
+    pending = {}
+    users = {}
+    # read where they are deleted: a replica that is behind would still hold
+    # the notices of digests already sent
+    notices = DigestNotice.objects.using(router.db_for_write(DigestNotice, lookup=True)
+                                         ).filter(recipient__in=user_ids)
+    for notice in notices.select_related("recipient", "notice_type"):
+        pending.setdefault(notice.recipient_id, []).append(notice)
+        users[notice.recipient_id] = notice.recipient
+
+    messages = []
+    current_language = get_language()
+    for language, group in group_by_language(users.values()):
+        activate(language or current_language)
+        for user in group:
+            if user.email and user.is_active:
+                messages.append(render_digest(user, pending[user.id]))
+    activate(current_language)
+
+    if messages:
+        get_connection().send_messages(messages)
+    sent_ids = [notice.id for user_notices in pending.values() for notice in user_notices]
+    DigestNotice.objects.filter(id__in=sent_ids).delete()
+    return len(messages)
+
+
+def send_digests(chunk_size=None, force=False):
+    '''
+    Sends a digest to every user whose oldest pending notice is older than
+    NOTIFICATION_DIGEST_INTERVAL minutes (or to every user with pending
+    notices if force is True), NOTIFICATION_DIGEST_CHUNK_SIZE users at a
+    time. Returns the number of digests sent.
+    '''
+    chunk_size = chunk_size or DIGEST_CHUNK_SIZE
+    due = DigestNotice.objects.all()
+    if not force:
+        due = due.filter(added__lte=timezone.now() - DIGEST_INTERVAL)
+    user_ids = due.order_by("recipient").values_list("recipient", flat=True).distinct()
+
+    sent = 0
+    last_id = 0
+    while True:
+        chunk = list(user_ids.filter(recipient__gt=last_id)[:chunk_size])
+        if not chunk:
+            return sent
+        last_id = chunk[-1]
+        sent += send_digest_chunk(chunk)
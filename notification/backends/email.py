@@ -3,15 +3,13 @@ from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 
 from django.core.urlresolvers import reverse
-from django.template import Context
-from django.template.loader import render_to_string
 from django.utils.translation import ugettext
 
 # Django Apps
 from django.contrib.sites.models import Site
 
 # This app
-from notification import backends
+from notification import backends, instrumentation
 
 
 class EmailBackend(backends.BaseBackend):
@@ -19,14 +17,35 @@ class EmailBackend(backends.BaseBackend):
 
     def can_send(self, user, notice_type):
         can_send = super(EmailBackend, self).can_send(user, notice_type)
-        if can_send and user.email:
+        if can_send and user.email and not self.digests(user, notice_type):
             return True
         return False
 
+    def digests(self, user, notice_type):
+        """
+        True when the user picked their email digest for notices of this
+        type instead of getting them right away. The setting counts even
+        when the user unsubscribed from the digest, so they then get no email
+        for these types rather than more.
+        """
+        from notification.models import NOTIFICATION_BACKENDS, get_notification_setting
+        for (medium_id, label), backend in NOTIFICATION_BACKENDS.items():
+            if label == 'digest':
+                return get_notification_setting(user, notice_type, medium_id).send
+        return False
+
     def deliver(self, recipient, sender, notice_type, extra_context):
+        with instrumentation.timer("render", self, notice_type):
+            msg = self.render(recipient, notice_type, extra_context)
+        with instrumentation.timer("smtp", self, notice_type):
+            msg.send()
+
+    def render(self, recipient, notice_type, extra_context):
+        """
+        Returns the email message of a notice to recipient.
+        """
+        context = dict(extra_context)
 
-        context = Context(extra_context)
-        
         short = backends.format_notification("short.txt",
                                              notice_type.label,
                                              context).rstrip('\n').rstrip('\r')
@@ -39,20 +58,25 @@ class EmailBackend(backends.BaseBackend):
                                                notice_type.label,
                                                context)
 
-        body = render_to_string(("notification/email_body.html",
-                                 "notification/default/email_body.html"),
-                                {"message": message}, context)
+        # "message" is rendered per recipient, the wrappers must not reuse it
+        context["message"] = message
+        body = backends.render_fragment(("notification/email_body.html",
+                                         "notification/default/email_body.html"),
+                                        context, dependent=["message"])
 
-        context.autoescape = False
-        subject = render_to_string(("notification/email_subject.txt",
-                                    "notification/default/email_subject.txt"),
-                                  {"message": short}, context).rstrip('\n').rstrip('\r')
-        body_txt = render_to_string(("notification/default/email_body.txt",
-                                     "notification/email_body.html"),
-                                    {"message": message_txt}, context)
+        context["message"] = short
+        subject = backends.render_fragment(("notification/email_subject.txt",
+                                            "notification/default/email_subject.txt"),
+                                           context, autoescape=False,
+                                           dependent=["message"]).rstrip('\n').rstrip('\r')
+        context["message"] = message_txt
+        body_txt = backends.render_fragment(("notification/default/email_body.txt",
+                                             "notification/email_body.html"),
+                                            context, autoescape=False,
+                                            dependent=["message"])
 
         msg = EmailMultiAlternatives(subject, body_txt,
                 settings.DEFAULT_FROM_EMAIL, [recipient.email])
 
         msg.attach_alternative(body, "text/html")
-        msg.send()
+        return msg
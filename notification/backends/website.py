@@ -2,7 +2,9 @@
 from datetime import datetime, timedelta
 
 # Django
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
@@ -12,6 +14,7 @@ from django.core.urlresolvers import reverse
 # Django Apps
 from django.contrib.sites.models import Site
 from django.utils.timezone import * 
+from django.utils import timezone
 
 # PickleField
 from picklefield.fields import PickledObjectField
@@ -22,7 +25,67 @@ from notification.models import NoticeType
 from django.conf import settings
 
 
+class NoticeQuerySet(QuerySet):
+    """
+    With NOTIFICATION_SEEN_WATERMARK, sets the unseen flag of the notices it
+    returns from their recipient's watermark, see NoticeManager.
+    """
+    watermarks = None
+
+    def with_watermarks(self, watermarks):
+        clone = self._clone()
+        clone.watermarks = watermarks
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault("watermarks", self.watermarks)
+        return super(NoticeQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        if not SEEN_WATERMARK:
+            for notice in super(NoticeQuerySet, self).iterator():
+                yield notice
+            return
+        watermarks = dict(self.watermarks or {})
+        for notice in super(NoticeQuerySet, self).iterator():
+            if notice.recipient_id not in watermarks:
+                watermarks[notice.recipient_id] = Notice.objects.seen_until(notice.recipient_id)
+            seen_until = watermarks[notice.recipient_id]
+            if (notice.unseen and seen_until is not None and
+                    notice.added <= seen_until and not notice.keep_unseen):
+                notice.unseen = False
+            yield notice
+
+
 class NoticeManager(models.Manager):
+    """
+    With NOTIFICATION_SEEN_WATERMARK set, marking all of a user's notices as
+    seen only moves their SeenWatermark: notices added up to it are seen,
+    unless marked unseen again afterwards (keep_unseen). The unseen flag of
+    the notices this manager returns takes the watermark into account.
+    """
+
+    def get_query_set(self):
+        return NoticeQuerySet(self.model, using=self._db)
+
+    def seen_until(self, user):
+        """
+        returns the time up to which all the user's notices are seen, or None.
+        """
+        if not SEEN_WATERMARK:
+            return None
+        watermark = SeenWatermark.objects.filter(user=user).values_list("seen_until", flat=True)[:1]
+        return watermark[0] if watermark else None
+
+    def unseen_q(self, user, seen_until=False):
+        """
+        returns the filter matching the user's unseen notices.
+        """
+        if seen_until is False:
+            seen_until = self.seen_until(user)
+        if seen_until is None:
+            return Q(unseen=True)
+        return Q(unseen=True) & (Q(added__gt=seen_until) | Q(keep_unseen=True))
 
     def notices_for(self, user, archived=False, unseen=None):
         """
@@ -30,11 +93,16 @@ class NoticeManager(models.Manager):
         archived : { False: only messages not archived, True: all messages }
         unseen : {None: all notices, True: only unseen, False: only seen}
         """
+        seen_until = self.seen_until(user)
         qs = self.filter(recipient=user)
         qs = qs.filter(archived=archived)
         if unseen is not None:
-            qs = qs.filter(unseen=unseen)
-        return qs
+            unseen_q = self.unseen_q(user, seen_until)
+            qs = qs.filter(unseen_q) if unseen else qs.exclude(unseen_q)
+        if SEEN_WATERMARK:
+            qs = qs.with_watermarks({user.id: seen_until})
+        # load each shared payload once for all the notices listed
+        return qs.prefetch_related("payload")
 
     def mark_read(self, sender, receiver):
         '''
@@ -45,10 +113,27 @@ class NoticeManager(models.Manager):
         if receiver.is_anonymous():
             return
         ctype = ContentType.objects.get_for_model(sender)
-        for n in self.filter(content_type=ctype, object_id=sender.id,
-                             recipient=receiver):
-            n.unseen = False
-            n.save()
+        self.filter(content_type=ctype, object_id=sender.id, recipient=receiver,
+                    unseen=True).update(unseen=False, keep_unseen=False)
+
+    def mark_all_seen(self, user):
+        """
+        Marks all the user's notices as seen.
+        """
+        if not SEEN_WATERMARK:
+            self.filter(recipient=user, archived=False, unseen=True).update(unseen=False)
+            return
+        now = timezone.now()
+        if not SeenWatermark.objects.filter(user=user).update(seen_until=now):
+            try:
+                sid = transaction.savepoint()
+                SeenWatermark.objects.create(user=user, seen_until=now)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # a concurrent request created it first
+                transaction.savepoint_rollback(sid)
+                SeenWatermark.objects.filter(user=user).update(seen_until=now)
+        self.filter(recipient=user, keep_unseen=True).update(unseen=False, keep_unseen=False)
 
     def unseen_count_for(self, recipient, **kwargs):
         """
@@ -60,6 +145,39 @@ class NoticeManager(models.Manager):
 current_site = Site.objects.get_current()
 root_url = "http://%s" % unicode(current_site)
 
+# Events for the same recipient, notice type and sender within this many
+# minutes of the last one update the unseen notice instead of adding one.
+COALESCE_WINDOW = getattr(settings, "NOTIFICATION_COALESCE_WINDOW", 0)
+
+# Track read state with a per user watermark instead of a flag per notice.
+SEEN_WATERMARK = getattr(settings, "NOTIFICATION_SEEN_WATERMARK", False)
+
+
+class SeenWatermark(models.Model):
+    '''
+    All the user's notices added up to seen_until are seen, see NoticeManager.
+    '''
+    user = models.OneToOneField(User, primary_key=True, verbose_name=_("user"))
+    seen_until = models.DateTimeField(_("seen until"))
+
+    class Meta:
+        app_label = 'notification'  # needed for syncdb
+        verbose_name = _("seen watermark")
+        verbose_name_plural = _("seen watermarks")
+
+
+class NoticePayload(models.Model):
+    '''
+    The extra context of a send, shared by all the notices it created.
+    '''
+    data = PickledObjectField()
+    added = models.DateTimeField(_("added"), auto_now_add=True)
+
+    class Meta:
+        app_label = 'notification'  # needed for syncdb
+        verbose_name = _("notice payload")
+        verbose_name_plural = _("notice payloads")
+
 
 class Notice(models.Model):
     '''
@@ -67,11 +185,22 @@ class Notice(models.Model):
     '''
     recipient = models.ForeignKey(User, verbose_name=_("recipient"))
     notice_type = models.ForeignKey(NoticeType, verbose_name=_("notice type"))
-    added = models.DateTimeField(_("added"), auto_now_add=True)
+    added = models.DateTimeField(_("added"), auto_now_add=True, db_index=True)
+    # when the first of the events coalesced into this notice was added;
+    # added moves with every coalesced event, this anchors the window
+    first_added = models.DateTimeField(_("first added"), auto_now_add=True, null=True)
     unseen = models.BooleanField(_("unseen"), default=True)
+    # marked unseen again below the recipient's SeenWatermark
+    keep_unseen = models.BooleanField(_("kept unseen"), default=False)
     archived = models.BooleanField(_("archived"), default=False)
+    # number of events coalesced into this notice, see WebsiteBackend
+    count = models.PositiveIntegerField(_("count"), default=1)
 
-    data = PickledObjectField()
+    # the extra context is either stored on the notice itself or, for sends
+    # to several users, in a payload shared with the other recipients.
+    data = PickledObjectField(null=True)
+    payload = models.ForeignKey(NoticePayload, null=True, blank=True,
+                                verbose_name=_("payload"))
 
     # Polymorphic relation to allow any object to be the sender
     content_type = models.ForeignKey(ContentType)
@@ -87,6 +216,14 @@ class Notice(models.Model):
         self.archived = True
         self.save()
         
+    def get_data(self):
+        """
+        returns a copy of the notice's extra context, safe to update.
+        """
+        if self.payload_id:
+            return dict(self.payload.data or {})
+        return dict(self.data or {})
+
     def get_context(self):
         """
         website specific context for use in all templates when website is present
@@ -98,9 +235,10 @@ class Notice(models.Model):
                    "sender_type": self.content_type.name, 
                    "object_id": self.object_id,
                    "notice_id": self.id,
+                   "count": self.count,
                 }
                 
-    def get_sender_url(self):
+    def get_sender_url(self, sender_path=None):
         '''
         sender_url: a path to the sender. If not specified in extra_context then a url 
         will be generated automatically (/content_type/sender.id/) if your url's are the 
@@ -108,8 +246,10 @@ class Notice(models.Model):
         then the sender_url will pass through view_sender view and mark the notice as seen.
         *If specified in extra_context, provide just the path and it will be converted to
         the proper url automatically.
+        When the caller knows the sender_path the notice's data is not loaded.
         '''
-        sender_path = self.data.get('sender_path', '')
+        if sender_path is None:
+            sender_path = self.get_data().get('sender_path', '')
         view_sender_url = reverse('notification_view_sender',args=[str(self.id)])+'?sender_url='
         
         sender_url = view_sender_url+sender_path
@@ -122,19 +262,17 @@ class Notice(models.Model):
         Render the notification with the given template.
         """
 
-        if not self.data: self.data = {}
-        
+        context = self.get_data()
+
         #provide context to replicate context provided by notification.send() for all templates
-        self.data.update({  "recipient": self.recipient, 
+        context.update({    "recipient": self.recipient, 
                             "sender": self.sender,  
                             "notice": self.notice_type,
                             "root_url": root_url,
                             "sender_url": self.get_sender_url(),
                         })
         #provide website specific context
-        self.data.update(self.get_context())
-        
-        context = self.data
+        context.update(self.get_context())
         
         short = backends.format_notification("short.txt",
                                              self.notice_type.label,
@@ -149,7 +287,7 @@ class Notice(models.Model):
                                                context)
         
         #provide website template specific context
-        self.data.update({  'message_short':short, 
+        context.update({    'message_short':short, 
                             'message_full':full,
                             'message_full_html':full_html,
                         })
@@ -167,10 +305,17 @@ class Notice(models.Model):
         """
         unseen = self.unseen
         if unseen:
-            self.unseen = False
-            self.save()
+            self.set_unseen(False)
         return unseen
 
+    def set_unseen(self, unseen):
+        """
+        Marks the notice as unseen or seen, whatever the recipient's watermark.
+        """
+        self.unseen = unseen
+        self.keep_unseen = bool(unseen and SEEN_WATERMARK)
+        self.save()
+
     class Meta:
         app_label = 'notification'  # needed for syncdb
         ordering = ["-added"]
@@ -185,11 +330,66 @@ class WebsiteBackend(backends.BaseBackend):
     """
     spam_sensitivity = 1
 
-    def deliver(self, recipient, sender, notice_type, extra_context):
+    def create_payload(self, extra_context):
+        """
+        Stores the extra context of a send once, for all its recipients.
+        """
+        return NoticePayload.objects.create(data=extra_context)
+
+    def deliver(self, recipient, sender, notice_type, extra_context, payload=None,
+                defer=False):
         """
         Just saves the notification to the database, it gets displayed
+
+        When a payload is given (see create_payload) the notice points to it
+        instead of storing its own copy of extra_context.
+
+        With defer the notice is returned unsaved, for the caller to save it
+        later with others, see notification.writebehind.
+
+        With NOTIFICATION_COALESCE_WINDOW set, an unseen notice of the same
+        type from the same sender first added within the window is updated
+        with the new context (the latest actor) and its count is increased.
+        The returned notice is then flagged as coalesced.
         """
-        Notice.objects.create(recipient=recipient,
-                              sender=sender,
-                              data=extra_context,
-                              notice_type=notice_type)
+        data = None if payload else extra_context
+        if COALESCE_WINDOW and sender is not None:
+            notice = self.coalesce(recipient, sender, notice_type, data, payload)
+            if notice:
+                return notice
+        notice = Notice(recipient=recipient,
+                        sender=sender,
+                        data=data,
+                        payload=payload,
+                        notice_type=notice_type)
+        if not defer:
+            notice.save()
+        notice.coalesced = False
+        return notice
+
+    def coalesce(self, recipient, sender, notice_type, data, payload):
+        now = timezone.now()
+        since = now - timedelta(minutes=COALESCE_WINDOW)
+        ctype = ContentType.objects.get_for_model(sender)
+        unseen_q = Notice.objects.unseen_q(recipient)
+        try:
+            notice = Notice.objects.filter(unseen_q,
+                                           recipient=recipient,
+                                           notice_type=notice_type,
+                                           content_type=ctype,
+                                           object_id=sender.id,
+                                           archived=False,
+                                           first_added__gte=since).order_by("-added")[0]
+        except IndexError:
+            return None
+        # counted in the database so concurrent sends do not lose events; a
+        # notice seen or archived since it was read gets a new one instead
+        if not Notice.objects.filter(unseen_q, pk=notice.pk, archived=False).update(
+                data=data, payload=payload, count=F("count") + 1, added=now):
+            return None
+        notice.data = data
+        notice.payload = payload
+        notice.count += 1
+        notice.added = now
+        notice.coalesced = True
+        return notice
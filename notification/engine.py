@@ -0,0 +1,175 @@
+import logging
+from datetime import timedelta
+
+# Django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import router, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+# This app
+from notification.models import (NoticeQueueBatch, ScheduledBatch, idempotency_digest,
+                                 release_idempotency_key, send_now)
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+SCHEDULE_CHUNK_SIZE = getattr(settings, "NOTIFICATION_SCHEDULE_CHUNK_SIZE", 500)
+
+# The queue partitions this worker sends, None for all of them.
+WORKER_PARTITIONS = getattr(settings, "NOTIFICATION_QUEUE_WORKER_PARTITIONS", None)
+
+# Every this many batches the oldest pending one is sent whatever its
+# priority, so a steady flow of urgent notices cannot starve the others.
+QUEUE_FAIR_SHARE = getattr(settings, "NOTIFICATION_QUEUE_FAIR_SHARE", 10)
+
+# A claimed batch is leased for this many minutes; when it was not sent by
+# then it is claimed again, at most NOTIFICATION_QUEUE_MAX_ATTEMPTS times.
+QUEUE_LEASE = getattr(settings, "NOTIFICATION_QUEUE_LEASE", 30)
+QUEUE_MAX_ATTEMPTS = getattr(settings, "NOTIFICATION_QUEUE_MAX_ATTEMPTS", 3)
+
+logger = logging.getLogger(__name__)
+
+
+def claim(batch):
+    '''
+    Leases a batch for NOTIFICATION_QUEUE_LEASE minutes unless another worker
+    claimed it since it was read. Returns True when the batch is ours to send.
+    '''
+    lease = timezone.now() + timedelta(minutes=QUEUE_LEASE)
+    return NoticeQueueBatch.objects.filter(id=batch.id,
+                                           processed__isnull=True,
+                                           leased_until=batch.leased_until
+                                           ).update(leased_until=lease,
+                                                    attempts=F("attempts") + 1) == 1
+
+
+def pending_batches(db, now):
+    '''
+    Returns the batches not sent yet that are not leased to a worker and
+    have attempts left.
+    '''
+    return NoticeQueueBatch.objects.using(db).filter(
+        Q(leased_until__isnull=True) | Q(leased_until__lte=now),
+        processed__isnull=True, attempts__lt=QUEUE_MAX_ATTEMPTS)
+
+
+def send_batch(batch):
+    '''
+    Sends the notices of one queued batch. A batch holds the notices of one
+    queue() call, so its users are sent to with as few send_now calls as
+    possible. Every send_now call has an idempotency key of its own, so a
+    batch sent again after a failure skips the groups already sent. The
+    batch is passed as read before it was claimed.
+    '''
+    notices = pickle.loads(str(batch.pickled_data).decode("base64"))
+    groups = []
+    for user_pk, label, extra_context, on_site, sender in notices:
+        key = (label, id(extra_context), id(sender))
+        if not groups or groups[-1][0] != key:
+            groups.append((key, [], label, extra_context, sender))
+        groups[-1][1].append(user_pk)
+    for index, (key, user_pks, label, extra_context, sender) in enumerate(groups):
+        # users which do not exist anymore are ignored
+        users = User.objects.filter(pk__in=user_pks)
+        idempotency_key = "queue-batch-%d-%d" % (batch.id, index)
+        if batch.attempts:
+            # the earlier attempt's lease ran out, so a group it left
+            # uncompleted is ours to resume; left alone, its key would skip
+            # the group until NOTIFICATION_IDEMPOTENCY_LEASE is over
+            release_idempotency_key(idempotency_digest(idempotency_key, label,
+                                                       users.values_list("pk", flat=True)))
+        send_now(users, label, extra_context, sender, idempotency_key=idempotency_key)
+
+
+@transaction.commit_on_success
+def release_chunk(now, chunk_size):
+    '''
+    Moves up to chunk_size due scheduled batches to the queue, earliest due
+    first. Returns the number of batches moved.
+    '''
+    # the lock must be taken on the primary, never on a replica
+    due = list(ScheduledBatch.objects.using(router.db_for_write(ScheduledBatch, lookup=True))
+                                     .select_for_update()
+                                     .filter(due__lte=now).order_by("due")[:chunk_size])
+    NoticeQueueBatch.objects.bulk_create([
+        NoticeQueueBatch(pickled_data=scheduled.pickled_data, priority=scheduled.priority,
+                         partition=scheduled.partition)
+        for scheduled in due])
+    ScheduledBatch.objects.filter(id__in=[scheduled.id for scheduled in due]).delete()
+    return len(due)
+
+
+def release_due(chunk_size=None):
+    '''
+    Moves every due scheduled batch to the queue, NOTIFICATION_SCHEDULE_CHUNK_SIZE
+    at a time. Only the due end of the due index is read, however many
+    batches are scheduled for later. Returns the number of batches moved.
+    '''
+    chunk_size = chunk_size or SCHEDULE_CHUNK_SIZE
+    now = timezone.now()
+    released = 0
+    while True:
+        count = release_chunk(now, chunk_size)
+        released += count
+        if count < chunk_size:
+            return released
+
+
+def fair_turn(taken):
+    '''
+    Returns True when the next item should be the oldest one rather than the
+    most urgent one, see NOTIFICATION_QUEUE_FAIR_SHARE.
+    '''
+    return bool(QUEUE_FAIR_SHARE) and taken % QUEUE_FAIR_SHARE == QUEUE_FAIR_SHARE - 1
+
+
+def send_all(limit=None, partitions=None):
+    '''
+    Queues the scheduled batches that are due, then sends the notices queued
+    in NoticeQueueBatch, highest priority first and oldest first within a
+    priority. Every batch is leased before it is sent so concurrent workers
+    never send it twice, and only marked processed once it was sent: a
+    batch whose send raised is retried by a later run once its lease ran
+    out. Processed batches are kept until purge_notices removes them.
+    Returns the number of batches sent.
+
+    Only the batches of the given partitions (NOTIFICATION_QUEUE_WORKER_PARTITIONS
+    by default) are sent, so workers owning different partitions never
+    compete for the same rows.
+    '''
+    if partitions is None:
+        partitions = WORKER_PARTITIONS
+    release_due()
+    # a replica that is behind would keep offering batches already claimed
+    primary = router.db_for_write(NoticeQueueBatch, lookup=True)
+    sent = 0
+    taken = 0
+    while limit is None or taken < limit:
+        pending = pending_batches(primary, timezone.now())
+        if partitions is not None:
+            pending = pending.filter(partition__in=partitions)
+        if fair_turn(taken):
+            pending = pending.order_by("id")
+        else:
+            pending = pending.order_by("-priority", "id")
+        batch = pending[:1]
+        if not batch:
+            return sent
+        batch = batch[0]
+        if not claim(batch):
+            continue
+        taken += 1
+        try:
+            send_batch(batch)
+        except Exception:
+            # the lease keeps the batch from being retried before it ran out
+            logger.exception("sending queued notice batch %s failed (attempt %d of %d)",
+                             batch.id, batch.attempts + 1, QUEUE_MAX_ATTEMPTS)
+            continue
+        NoticeQueueBatch.objects.filter(id=batch.id).update(processed=timezone.now())
+        sent += 1
+    return sent
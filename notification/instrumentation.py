@@ -0,0 +1,135 @@
+'''
+Timers and counters around the stages of a delivery.
+
+With NOTIFICATION_INSTRUMENTATION = True, send_now and the outbox time each
+stage of a send and count what they did, per stage, backend and notice type:
+
+    settings   loading the notice settings of a chunk of recipients
+    website    saving the website notices
+    render     rendering the email templates of a recipient
+    smtp       handing an email to the mail backend
+    deliver    a whole delivery by a backend other than the website one
+    outbox     recording the outbox deliveries of a chunk
+
+Every measure is sent with the stage_timed and stage_counted signals, which
+a statsd or Prometheus adapter can receive:
+
+    from notification.instrumentation import stage_timed
+
+    @receiver(stage_timed)
+    def to_statsd(sender, stage, backend, notice_type, seconds, **kwargs):
+        statsd.timing("notification.%s.%s" % (stage, backend), seconds * 1000)
+
+The aggregator totals them in the process. The notification_metrics
+management command runs another command with the instrumentation enabled
+and dumps the totals afterwards.
+
+When disabled, timer returns a shared do nothing context manager and count
+returns at once, without sending the signals.
+'''
+# Python Core
+import threading
+import time
+
+# Django
+from django.conf import settings
+from django.dispatch import Signal
+
+enabled = getattr(settings, "NOTIFICATION_INSTRUMENTATION", False)
+
+stage_timed = Signal(providing_args=["stage", "backend", "notice_type", "seconds"])
+stage_counted = Signal(providing_args=["stage", "backend", "notice_type", "count"])
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+
+    def __init__(self, stage, backend, notice_type):
+        self.stage = stage
+        self.backend = backend
+        self.notice_type = notice_type
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_timed.send(sender=Timer, stage=self.stage, backend=self.backend,
+                         notice_type=self.notice_type, seconds=time.time() - self.start)
+
+
+def label_of(obj):
+    return getattr(obj, "label", obj)
+
+
+def timer(stage, backend=None, notice_type=None):
+    '''
+    Returns a context manager timing the block as stage, for the backend and
+    notice type given as objects or labels.
+    '''
+    if not enabled:
+        return NULL_TIMER
+    return Timer(stage, label_of(backend), label_of(notice_type))
+
+
+def count(stage, backend=None, notice_type=None, n=1):
+    if not enabled:
+        return
+    stage_counted.send(sender=Timer, stage=stage, backend=label_of(backend),
+                       notice_type=label_of(notice_type), count=n)
+
+
+class Aggregator(object):
+    '''
+    Totals the timings and counts received, by (stage, backend, notice type).
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counts = {}
+
+    def timed(self, sender, stage, backend, notice_type, seconds, **kwargs):
+        key = (stage, backend, notice_type)
+        with self.lock:
+            calls, total, slowest = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (calls + 1, total + seconds, max(slowest, seconds))
+
+    def counted(self, sender, stage, backend, notice_type, count, **kwargs):
+        key = (stage, backend, notice_type)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def snapshot(self):
+        '''
+        Returns a list of dicts, one per stage, backend and notice type.
+        '''
+        with self.lock:
+            keys = set(self.timings) | set(self.counts)
+            rows = []
+            for stage, backend, notice_type in sorted(keys):
+                calls, total, slowest = self.timings.get((stage, backend, notice_type),
+                                                         (0, 0.0, 0.0))
+                rows.append({"stage": stage, "backend": backend,
+                             "notice_type": notice_type, "calls": calls,
+                             "seconds": total, "slowest": slowest,
+                             "count": self.counts.get((stage, backend, notice_type), 0)})
+            return rows
+
+aggregator = Aggregator()
+stage_timed.connect(aggregator.timed, dispatch_uid="notification.instrumentation.aggregator")
+stage_counted.connect(aggregator.counted, dispatch_uid="notification.instrumentation.aggregator")
@@ -1,20 +1,98 @@
 from django.conf import settings
+from django.db import router, transaction
 from django.db.models import signals
 from django.utils.translation import ugettext_noop as _
 
 notice_types = getattr(settings, 'NOTICE_TYPES', None)
-def create_notice_types():
-    for type in notice_types:
-        notification.create_notice_type(type[0],_(type[1]), _(type[2]))
-    print 'notice types are now up to date'
+
+
+def wanted_notice_types():
+    '''
+    Returns a dictionary of label to the NoticeType fields NOTICE_TYPES asks
+    for. Entries are (label, display, description) with an optional priority,
+    which is left alone when missing.
+    '''
+    wanted = {}
+    for type in notice_types or []:
+        fields = {"display": _(type[1]), "description": _(type[2]), "default": 2}
+        if len(type) > 3:
+            fields["priority"] = type[3]
+        wanted[type[0]] = fields
+    return wanted
+
+
+def diff_notice_types():
+    '''
+    Compares NOTICE_TYPES with the database using a single query. Returns
+    the NoticeTypes to create, the NoticeTypes to update and the NoticeTypes
+    that are not in NOTICE_TYPES anymore.
+    '''
+    wanted = wanted_notice_types()
+    # read where the changes are written, not from a replica
+    notice_types = notification.NoticeType.objects.db_manager(
+        router.db_for_write(notification.NoticeType, lookup=True))
+    existing = dict((notice_type.label, notice_type)
+                    for notice_type in notice_types.all())
+    to_create = []
+    to_update = []
+    for label, fields in sorted(wanted.items()):
+        notice_type = existing.get(label)
+        if notice_type is None:
+            to_create.append(notification.NoticeType(label=label, **fields))
+            continue
+        changed = False
+        for name, value in fields.items():
+            if getattr(notice_type, name) != value:
+                setattr(notice_type, name, value)
+                changed = True
+        if changed:
+            to_update.append(notice_type)
+    stale = [notice_type for label, notice_type in sorted(existing.items())
+             if label not in wanted]
+    return to_create, to_update, stale
+
+
+def create_notice_types(verbosity=1, check=False, prune=False):
+    '''
+    Brings the NoticeTypes in line with NOTICE_TYPES in one transaction:
+    missing types are created at once, changed ones updated, and with prune
+    the types not in NOTICE_TYPES anymore are deleted along with their
+    notices and settings. With check nothing is written. Returns the
+    created, updated and stale (pruned or not) NoticeTypes.
+    '''
+    to_create, to_update, stale = diff_notice_types()
+    if not check:
+        with transaction.commit_on_success():
+            notification.NoticeType.objects.bulk_create(to_create)
+            for notice_type in to_update:
+                notification.NoticeType.objects.filter(pk=notice_type.pk).update(
+                    display=notice_type.display,
+                    description=notice_type.description,
+                    default=notice_type.default,
+                    priority=notice_type.priority)
+            if prune and stale:
+                notification.NoticeType.objects.filter(
+                    pk__in=[notice_type.pk for notice_type in stale]).delete()
+    if verbosity > 1:
+        for notice_type in to_create:
+            print "%s %s NoticeType" % (check and "Missing" or "Created", notice_type.label)
+        for notice_type in to_update:
+            print "%s %s NoticeType" % (check and "Changed" or "Updated", notice_type.label)
+        for notice_type in stale:
+            print "%s %s NoticeType" % (prune and not check and "Deleted" or "Stale", notice_type.label)
+    if verbosity > 0:
+        print 'notice types: %d %s, %d %s, %d %s' % (
+            len(to_create), check and "missing" or "created",
+            len(to_update), check and "changed" or "updated",
+            len(stale), prune and not check and "deleted" or "not in NOTICE_TYPES")
+    return to_create, to_update, stale
 
 if "notification" in settings.INSTALLED_APPS:
     from notification import models as notification
     def run_create_notice_types(app, created_models, verbosity, **kwargs):
         if app == notification:
-            print 'creating notice types'
-            create_notice_types()
+            create_notice_types(verbosity)
     signals.post_syncdb.connect(run_create_notice_types, sender=notification)
 else:
     print "Skipping creation of NoticeTypes as notification app not found"
-    
+
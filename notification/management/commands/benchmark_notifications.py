@@ -0,0 +1,199 @@
+from optparse import make_option
+from StringIO import StringIO
+import gc
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, reset_queries, transaction
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+
+from notification import models as notification
+from notification.backends.website import Notice
+from notification.context_processors import notification as notification_context
+
+LABEL = 'benchmark_notice'
+PASSWORD = 'benchmark'
+
+
+def peak_memory():
+    '''
+    Returns the peak resident memory of the process in kilobytes, or None.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes elsewhere
+    return peak / 1024 if sys.platform == 'darwin' else peak
+
+
+class Command(BaseCommand):
+
+    help = ('runs fan-out, rendering and view benchmarks on synthetic users '
+            'with the locmem email backend, reporting time, queries and peak '
+            'memory per operation; nothing is kept in the database')
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=500,
+                    help='number of synthetic recipients and observers (default 500)'),
+        make_option('--notices', type='int', default=50,
+                    help='number of notices rendered and listed (default 50)'),
+        make_option('--save-baseline', dest='save_baseline', default=None,
+                    help='write the results to this JSON file'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='compare the results with this JSON file and fail on regressions'),
+        make_option('--tolerance', type='float', default=0.25,
+                    help='allowed slowdown against the baseline (default 0.25 for 25%%)'),
+    )
+
+    def handle(self, *args, **options):
+        self.results = {}
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                self.run_benchmarks(options['users'], options['notices'])
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            # the synthetic data is never kept
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            mail.outbox = []
+
+        self.report()
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as baseline:
+                json.dump(self.results, baseline, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                self.compare(json.load(baseline), options['tolerance'])
+
+    def run_benchmarks(self, count, notice_count):
+        notice_type = notification.NoticeType.objects.create(
+            label=LABEL, display='Benchmark', description='has benchmarked your user', default=2)
+        users = [User(username='benchmark%d' % i, email='benchmark%d@example.com' % i)
+                 for i in xrange(count)]
+        User.objects.bulk_create(users)
+        users = list(User.objects.filter(username__startswith='benchmark').order_by('id'))
+        sender = users[0]
+        reader = users[1]
+        reader.set_password(PASSWORD)
+        reader.save()
+        for user in users:
+            notification.Observation.objects.create(
+                user=user, notice_type=notice_type,
+                content_type=ContentType.objects.get_for_model(sender), object_id=sender.id)
+
+        self.measure('send_now', count, lambda: notification.send_now(
+            users, LABEL, {'benchmark': True}, sender=sender))
+        self.measure('send_observation_notices_for', count, lambda:
+            notification.send_observation_notices_for(sender, LABEL))
+        self.measure('broadcast', User.objects.count(), lambda:
+            notification.broadcast(LABEL, sender=sender))
+
+        for i in xrange(notice_count):
+            notification.send_now([reader], LABEL, {'benchmark': i}, sender=sender)
+        notices = list(Notice.objects.notices_for(reader)[:notice_count])
+        self.measure('Notice.render', len(notices), lambda: [notice.render() for notice in notices])
+
+        client = Client()
+        client.login(username=reader.username, password=PASSWORD)
+        for name, url in (('notices view', reverse('notification_notices')),
+                          ('notice_settings view', reverse('notification_notice_settings')),
+                          ('observation_settings view',
+                           reverse('notificaton_observation_settings', args=['user']))):
+            self.measure(name, 1, lambda: self.get(client, url))
+
+        request = RequestFactory().get('/')
+        request.user = reader
+        self.measure('context processor', 1, lambda: notification_context(request))
+
+    def get(self, client, url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise CommandError('%s answered %s' % (url, response.status_code))
+
+    def measure(self, name, units, operation):
+        '''
+        Runs operation once, recording its wall time, number of queries and
+        growth of the peak memory. Output of the operation is discarded.
+        '''
+        gc.collect()
+        reset_queries()
+        peak = peak_memory()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        start = time.time()
+        try:
+            operation()
+            error = None
+        except Exception, e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+        finally:
+            elapsed = time.time() - start
+            sys.stdout = stdout
+        result = {
+            'units': units,
+            'seconds': elapsed,
+            'queries': len(connection.queries),
+        }
+        if peak is not None:
+            result['peak_memory_kb'] = peak_memory() - peak
+        if error:
+            result['error'] = error
+        self.results[name] = result
+
+    def report(self):
+        self.stdout.write('%-28s %6s %9s %8s %10s %10s\n' % (
+            'operation', 'units', 'seconds', 'queries', 'q/unit', 'peak +KB'))
+        for name, result in sorted(self.results.items()):
+            if 'error' in result:
+                self.stdout.write('%-28s failed: %s\n' % (name, result['error']))
+                continue
+            self.stdout.write('%-28s %6d %9.3f %8d %10.2f %10s\n' % (
+                name, result['units'], result['seconds'], result['queries'],
+                float(result['queries']) / max(result['units'], 1),
+                result.get('peak_memory_kb', '-')))
+
+    def compare(self, baseline, tolerance):
+        '''
+        Reports the operations slower or running more queries per unit than
+        in the baseline, the ones failing that did not fail in it and the
+        ones missing, and fails if there are any.
+        '''
+        regressions = []
+        for name in sorted(set(baseline) - set(self.results)):
+            regressions.append('%s: no result, baseline has one' % name)
+        for name, result in sorted(self.results.items()):
+            base = baseline.get(name)
+            if base and 'error' in result and 'error' not in base:
+                regressions.append('%s: %s' % (name, result['error']))
+            if not base or 'error' in result or 'error' in base:
+                continue
+            per_unit = result['seconds'] / max(result['units'], 1)
+            base_per_unit = base['seconds'] / max(base['units'], 1)
+            if per_unit > base_per_unit * (1 + tolerance):
+                regressions.append('%s: %.2fms per unit, baseline %.2fms' % (
+                    name, per_unit * 1000, base_per_unit * 1000))
+            queries = float(result['queries']) / max(result['units'], 1)
+            base_queries = float(base['queries']) / max(base['units'], 1)
+            if queries > base_queries:
+                regressions.append('%s: %.2f queries per unit, baseline %.2f' % (
+                    name, queries, base_queries))
+        for regression in regressions:
+            self.stdout.write('REGRESSION %s\n' % regression)
+        if regressions:
+            raise CommandError('%d regressions against the baseline' % len(regressions))
+        self.stdout.write('no regressions against the baseline\n')
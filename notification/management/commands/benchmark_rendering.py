@@ -0,0 +1,94 @@
+from optparse import make_option
+import time
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+
+from notification import backends
+from notification import models as notification
+
+
+class Command(BaseCommand):
+
+    help = ('measures email rendering throughput for a fan-out, rendering '
+            'every recipient from scratch and with shared rendering')
+    option_list = BaseCommand.option_list + (
+        make_option('--recipients', type='int', default=10000,
+                    help='number of recipients to render for (default 10000)'),
+        make_option('--label', default=None,
+                    help='notice type to render (default: the first one)'),
+    )
+
+    modes = (
+        ('per recipient', None, False),
+        ('per template', {}, False),
+        ('shared', {}, True),
+    )
+
+    def handle(self, *args, **options):
+        count = options['recipients']
+        if options['label']:
+            try:
+                notice_type = notification.NoticeType.objects.get(label=options['label'])
+            except notification.NoticeType.DoesNotExist:
+                raise CommandError('no notice type labeled %s' % options['label'])
+        else:
+            notice_type = notification.NoticeType.objects.all()[:1]
+            if not notice_type:
+                raise CommandError('no notice types, run update_notice_types first')
+            notice_type = notice_type[0]
+
+        # recipients are never saved, the benchmark only renders and sends
+        # to the locmem mail backend.
+        users = [User(id=i, username='recipient%d' % i,
+                      email='recipient%d@example.com' % i)
+                 for i in xrange(1, count + 1)]
+        sender = users[0]
+        email = [backend for key, backend in notification.NOTIFICATION_BACKENDS.items()
+                 if key[1] == 'email'][0]
+
+        shared_rendering = backends.SHARED_RENDERING
+        reference = None
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                for name, fragments, split in self.modes:
+                    backends.SHARED_RENDERING = split
+                    mail.outbox = []
+                    if fragments is not None:
+                        fragments = {}
+                    start = time.time()
+                    for user in users:
+                        context = self.get_context(user, sender, notice_type, fragments)
+                        email.deliver(user, sender, notice_type, context)
+                    elapsed = time.time() - start
+                    messages = [(m.subject, m.body, m.alternatives[0][0]) for m in mail.outbox]
+                    if reference is None:
+                        reference = messages
+                    self.stdout.write('%-14s %8.2fs %10.1f recipients/s  %s\n' % (
+                        name, elapsed, count / elapsed,
+                        'same output' if messages == reference else 'OUTPUT DIFFERS'))
+        finally:
+            backends.SHARED_RENDERING = shared_rendering
+            mail.outbox = []
+
+    def get_context(self, user, sender, notice_type, fragments):
+        '''
+        The context send_now provides to non website backends.
+        '''
+        context = {
+            "from_user": sender,
+            "notice_id": False,
+            "sender_url": notification.root_url + '/user/%s/' % sender.id,
+            "recipient": user,
+            "sender": sender,
+            "notice": notice_type,
+            "notices_url": notification.root_url + '/notices/',
+            "root_url": notification.root_url,
+            "current_site": notification.current_site,
+            "unsubscribe_link": notification.root_url + '/unsubscribe/%s/' % user.id,
+        }
+        if fragments is not None:
+            context[backends.FRAGMENTS_KEY] = fragments
+        return context
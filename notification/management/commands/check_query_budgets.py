@@ -0,0 +1,53 @@
+from optparse import make_option
+from StringIO import StringIO
+import sys
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from notification.querybudget import check_budgets
+
+
+class Command(BaseCommand):
+
+    help = ('runs the public functions and views on synthetic data and fails '
+            'if one runs more queries than its budget; nothing is kept in the database')
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='5,10',
+                    help='comma separated input sizes to run every case at (default 5,10)'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes takes comma separated numbers')
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        stdout = sys.stdout
+        # the code under test prints
+        sys.stdout = StringIO()
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                results = check_budgets(sizes)
+        finally:
+            sys.stdout = stdout
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            mail.outbox = []
+
+        failed = 0
+        for name, budget, runs, diff in results:
+            status = 'over budget' if diff else 'ok'
+            self.stdout.write('%-30s budget %-26s %s  %s\n' % (
+                name, budget, '  '.join('%d items: %d/%d' % run for run in runs), status))
+            if diff:
+                failed += 1
+                self.stdout.write('    queries grown from %d to %d items:\n' % (runs[0][0], runs[-1][0]))
+                for line in diff:
+                    self.stdout.write('    %s\n' % line)
+        if failed:
+            raise CommandError('%d code paths over their query budget' % failed)
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from notification.outbox import send_deliveries, send_lanes, lane_stats
+
+
+class Command(BaseCommand):
+
+    help = 'sends the due deliveries of the notification outbox'
+    option_list = BaseCommand.option_list + (
+        make_option('--medium', dest='medium', default=None,
+                    help='only send the deliveries of this medium id'),
+        make_option('--lanes', action='store_true', dest='lanes', default=False,
+                    help='drain every backend at once, see NOTIFICATION_OUTBOX_LANES'),
+        make_option('--stats', action='store_true', dest='stats', default=False,
+                    help='only show the depth and lag of every lane'),
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='maximum number of deliveries to handle (per worker with --lanes)'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None,
+                    help='deliveries claimed at a time (default NOTIFICATION_OUTBOX_CHUNK_SIZE)'),
+    )
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for label, stats in sorted(lane_stats().items()):
+                self.stdout.write('%-10s pending %6d  due %6d  dead %6d  lag %8.1fs  workers %d\n' % (
+                    label, stats['pending'], stats['due'], stats['dead'],
+                    stats['lag'], stats['workers']))
+            return
+        if options['lanes']:
+            for label, sent in sorted(send_lanes(options['limit']).items()):
+                self.stdout.write('%s: sent %d deliveries\n' % (label, sent))
+            return
+        sent = send_deliveries(options['medium'], options['limit'], options['chunk_size'])
+        self.stdout.write('sent %d deliveries\n' % sent)
@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from notification.engine import send_all
+
+
+class Command(BaseCommand):
+
+    help = 'sends the notices queued with notification.queue'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='maximum number of queued batches to send'),
+        make_option('--partitions', dest='partitions', default=None,
+                    help='comma separated queue partitions to send '
+                         '(default NOTIFICATION_QUEUE_WORKER_PARTITIONS, or all)'),
+    )
+
+    def handle(self, *args, **options):
+        partitions = options['partitions']
+        if partitions is not None:
+            try:
+                partitions = [int(p) for p in partitions.split(',')]
+            except ValueError:
+                raise CommandError('--partitions takes comma separated numbers')
+        sent = send_all(options['limit'], partitions)
+        self.stdout.write('sent %d queued batches\n' % sent)
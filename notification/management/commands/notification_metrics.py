@@ -0,0 +1,56 @@
+from optparse import make_option
+import json
+
+from django.core.management import get_commands, load_command_class
+from django.core.management.base import BaseCommand, CommandError
+
+from notification import instrumentation
+
+
+class Command(BaseCommand):
+
+    args = '<command> [<option or argument> ...]'
+    help = ('runs a management command (emit_notices, deliver_notices, ...) with '
+            'the notification instrumentation enabled, then dumps the time spent '
+            'and the count of every delivery stage per backend and notice type')
+    option_list = BaseCommand.option_list + (
+        make_option('--json', action='store_true', dest='json', default=False,
+                    help='dump the metrics as JSON'),
+    )
+
+    def create_parser(self, prog_name, subcommand):
+        parser = super(Command, self).create_parser(prog_name, subcommand)
+        # the options after the command name are the command's
+        parser.disable_interspersed_args()
+        return parser
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('give the command to run, e.g. notification_metrics emit_notices')
+        name = args[0]
+        try:
+            command = load_command_class(get_commands()[name], name)
+        except KeyError:
+            raise CommandError('unknown command %r' % name)
+        command_options, command_args = command.create_parser('manage.py', name).parse_args(
+            list(args[1:]))
+
+        enabled = instrumentation.enabled
+        instrumentation.enabled = True
+        instrumentation.aggregator.reset()
+        try:
+            command.execute(*command_args, **command_options.__dict__)
+        finally:
+            instrumentation.enabled = enabled
+        self.dump(instrumentation.aggregator.snapshot(), options['json'])
+
+    def dump(self, rows, as_json):
+        if as_json:
+            self.stdout.write(json.dumps(rows, indent=2, sort_keys=True) + '\n')
+            return
+        self.stdout.write('%-10s %-10s %-30s %7s %7s %10s %10s\n' % (
+            'stage', 'backend', 'notice type', 'calls', 'count', 'seconds', 'slowest'))
+        for row in rows:
+            self.stdout.write('%-10s %-10s %-30s %7d %7d %10.3f %10.3f\n' % (
+                row['stage'], row['backend'] or '-', row['notice_type'] or '-',
+                row['calls'], row['count'], row['seconds'], row['slowest']))
@@ -0,0 +1,245 @@
+from optparse import make_option
+from StringIO import StringIO
+import cProfile
+import gc
+import os
+import pstats
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from django.conf import settings
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import models, transaction
+from django.test.utils import override_settings
+
+import notification
+from notification import models as notification_models
+from notification.backends.website import Notice
+from notification.engine import send_batch
+from notification.management.commands.benchmark_notifications import peak_memory
+
+LABEL = 'profile_notice'
+OPERATIONS = ('send_now', 'observers', 'broadcast', 'emit', 'render')
+NOTIFICATION_DIR = os.path.dirname(os.path.abspath(notification.__file__))
+PYTHON_DIR = os.path.dirname(os.path.abspath(os.__file__))
+
+
+def module_of(filename):
+    '''
+    Returns the name hotspots in filename are grouped under: the module path
+    for this app, the top level package for the others, "python" for the
+    standard library.
+    '''
+    if not filename or filename == '~' or filename.startswith('<'):
+        return 'builtins'
+    filename = os.path.abspath(filename)
+    if filename.startswith(NOTIFICATION_DIR + os.sep):
+        return 'notification/' + os.path.relpath(filename, NOTIFICATION_DIR)
+    paths = sorted((os.path.abspath(path) for path in sys.path if path), key=len, reverse=True)
+    for path in paths:
+        if filename.startswith(path + os.sep):
+            if path == PYTHON_DIR:
+                return 'python'
+            return os.path.relpath(filename, path).split(os.sep)[0]
+    return filename
+
+
+class Command(BaseCommand):
+
+    help = ('creates a synthetic workload and runs one notification operation '
+            'under cProfile, or with --memory under tracemalloc, reporting the '
+            'hotspots grouped by module; nothing is kept in the database')
+    option_list = BaseCommand.option_list + (
+        make_option('--operation', default='send_now', choices=OPERATIONS,
+                    help='operation to profile: %s (default send_now)' % ', '.join(OPERATIONS)),
+        make_option('--users', type='int', default=1000,
+                    help='number of synthetic recipients (default 1000)'),
+        make_option('--notice-types', dest='notice_types', type='int', default=10,
+                    help='number of synthetic notice types (default 10)'),
+        make_option('--observers', type='int', default=None,
+                    help='number of users observing the sender (default all)'),
+        make_option('--languages', default=None,
+                    help='comma separated languages given to the users in turn, '
+                         'needs NOTIFICATION_LANGUAGE_MODULE'),
+        make_option('--backends', default=None,
+                    help='comma separated backend labels the users receive notices '
+                         'with (default their default settings)'),
+        make_option('--memory', action='store_true', dest='memory', default=False,
+                    help='report allocation sites instead of time'),
+        make_option('--top', type='int', default=20,
+                    help='number of hotspots to show (default 20)'),
+        make_option('--output', default=None,
+                    help='write the raw cProfile stats to this file, for pstats, '
+                         'snakeviz or gprof2dot'),
+    )
+
+    def handle(self, *args, **options):
+        if options['memory'] and options['output']:
+            raise CommandError('--output writes cProfile stats, it does not go with --memory')
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        stdout = sys.stdout
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+                operation = self.create_workload(options)
+                # the code under profile prints
+                sys.stdout = StringIO()
+                try:
+                    if options['memory']:
+                        report = self.profile_memory(operation, options['top'])
+                    else:
+                        report = self.profile_time(operation, options['top'], options['output'])
+                finally:
+                    sys.stdout = stdout
+        finally:
+            # the synthetic workload is never kept
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            mail.outbox = []
+        self.stdout.write(report)
+
+    def create_workload(self, options):
+        '''
+        Creates the users, notice types, observations, languages and settings
+        of the workload. Returns the operation to profile.
+        '''
+        notice_types = [notification_models.NoticeType.objects.create(
+            label='%s_%d' % (LABEL, i), display='Profile %d' % i,
+            description='has profiled your user', default=2)
+            for i in xrange(max(options['notice_types'], 1))]
+        notice_type = notice_types[0]
+        User.objects.bulk_create([User(username='profile%d' % i, email='profile%d@example.com' % i)
+                                  for i in xrange(max(options['users'], 2))])
+        users = list(User.objects.filter(username__startswith='profile').order_by('id'))
+        sender = users[0]
+
+        observers = users if options['observers'] is None else users[:options['observers']]
+        notification_models.Observation.objects.bulk_create([
+            notification_models.Observation(user=user, notice_type=notice_type,
+                                            observed_object=sender)
+            for user in observers])
+
+        if options['languages']:
+            self.set_languages(users, options['languages'].split(','))
+        if options['backends']:
+            self.set_backends(users, notice_type, options['backends'].split(','))
+
+        label = notice_type.label
+        operation = options['operation']
+        if operation == 'send_now':
+            return lambda: notification_models.send_now(users, label, {'profile': True},
+                                                        sender=sender)
+        if operation == 'observers':
+            return lambda: notification_models.send_observation_notices_for(sender, label)
+        if operation == 'broadcast':
+            return lambda: notification_models.broadcast(label, sender=sender)
+        if operation == 'emit':
+            # send_batch rather than send_all, which commits the workload
+            notification_models.queue(users, label, {'profile': True}, sender=sender)
+            batches = list(notification_models.NoticeQueueBatch.objects.filter(
+                processed__isnull=True))
+            return lambda: [send_batch(batch) for batch in batches]
+        # render: every website notice of the send
+        notification_models.send_now(users, label, {'profile': True}, sender=sender)
+        notices = list(Notice.objects.filter(notice_type=notice_type))
+        return lambda: [notice.render() for notice in notices]
+
+    def set_languages(self, users, languages):
+        module = getattr(settings, 'NOTIFICATION_LANGUAGE_MODULE', False)
+        if not module:
+            raise CommandError('--languages needs NOTIFICATION_LANGUAGE_MODULE')
+        model = models.get_model(*module.split('.'))
+        model._default_manager.bulk_create([
+            model(user=user, language=languages[i % len(languages)])
+            for i, user in enumerate(users)])
+
+    def set_backends(self, users, notice_type, labels):
+        media = [unicode(medium_id) for medium_id, label in notification_models.NOTICE_MEDIA
+                 if label in labels]
+        unknown = set(labels) - set(label for medium_id, label in notification_models.NOTICE_MEDIA)
+        if unknown:
+            raise CommandError('unknown backends: %s' % ', '.join(sorted(unknown)))
+        notification_models.get_notification_settings(users, [notice_type])
+        user_settings = notification_models.NoticeSetting.objects.filter(
+            user__in=users, notice_type=notice_type)
+        user_settings.filter(medium__in=media).update(send=True)
+        user_settings.exclude(medium__in=media).update(send=False)
+
+    def profile_time(self, operation, top, output):
+        profile = cProfile.Profile()
+        profile.runcall(operation)
+        if output:
+            profile.dump_stats(output)
+        report = StringIO()
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats('cumulative').print_stats(top)
+
+        modules = {}
+        for (filename, line, name), (calls, primitive, own, cumulative, callers) in stats.stats.items():
+            calls_total, own_total = modules.get(module_of(filename), (0, 0.0))
+            modules[module_of(filename)] = (calls_total + calls, own_total + own)
+        report.write('%-60s %10s %10s\n' % ('own time by module', 'calls', 'seconds'))
+        for module, (calls, own) in sorted(modules.items(), key=lambda item: -item[1][1])[:top]:
+            report.write('%-60s %10d %10.3f\n' % (module, calls, own))
+        if output:
+            report.write('\nraw profile written to %s\n' % output)
+        return report.getvalue()
+
+    def profile_memory(self, operation, top):
+        '''
+        Reports the allocation sites with tracemalloc. Without it, as on
+        Python 2 without the pytracemalloc backport, reports the growth of the
+        number of live objects per type and of the peak memory instead.
+        '''
+        report = StringIO()
+        if tracemalloc is not None:
+            tracemalloc.start(10)
+            try:
+                operation()
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                tracemalloc.stop()
+            report.write('%-60s %10s %10s\n' % ('allocation site', 'KB', 'blocks'))
+            for stat in snapshot.statistics('lineno')[:top]:
+                frame = stat.traceback[0]
+                report.write('%-60s %10.1f %10d\n' % (
+                    '%s:%s' % (module_of(frame.filename), frame.lineno),
+                    stat.size / 1024.0, stat.count))
+            modules = {}
+            for stat in snapshot.statistics('filename'):
+                module = module_of(stat.traceback[0].filename)
+                modules[module] = modules.get(module, 0) + stat.size
+            report.write('\n%-60s %10s\n' % ('allocated by module', 'KB'))
+            for module, size in sorted(modules.items(), key=lambda item: -item[1])[:top]:
+                report.write('%-60s %10.1f\n' % (module, size / 1024.0))
+            return report.getvalue()
+
+        gc.collect()
+        before = self.count_objects()
+        peak = peak_memory()
+        result = operation()
+        gc.collect()
+        after = self.count_objects()
+        del result
+        report.write('tracemalloc is not available, live objects per type instead\n')
+        report.write('%-60s %10s\n' % ('type', 'new'))
+        growth = sorted(((after[key] - before.get(key, 0), key) for key in after), reverse=True)
+        for new, key in growth[:top]:
+            if new > 0:
+                report.write('%-60s %10d\n' % ('%s.%s' % key, new))
+        if peak is not None:
+            report.write('\npeak memory grew by %d KB\n' % (peak_memory() - peak))
+        return report.getvalue()
+
+    def count_objects(self):
+        counts = {}
+        for obj in gc.get_objects():
+            key = (type(obj).__module__, type(obj).__name__)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
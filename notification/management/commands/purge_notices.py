@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from notification import retention
+
+
+class Command(BaseCommand):
+
+    help = 'deletes notices, queue batches and outbox deliveries past their retention, in small chunks'
+    option_list = BaseCommand.option_list + (
+        make_option('--archived-days', type='int', dest='archived', default=None,
+                    help='delete archived notices older than this many days'),
+        make_option('--seen-days', type='int', dest='seen', default=None,
+                    help='delete seen notices older than this many days'),
+        make_option('--per-user', type='int', dest='per_user', default=None,
+                    help='keep at most this many notices per user'),
+        make_option('--queue-days', type='int', dest='queue', default=None,
+                    help='delete queue batches processed more than this many days ago'),
+        make_option('--outbox-days', type='int', dest='outbox', default=None,
+                    help='delete outbox deliveries sent more than this many days ago'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None,
+                    help='rows deleted per statement (default NOTIFICATION_PURGE_CHUNK_SIZE)'),
+        make_option('--pause', type='float', dest='pause', default=None,
+                    help='seconds to sleep between chunks (default NOTIFICATION_PURGE_PAUSE)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='only count the rows the policies would delete'),
+    )
+
+    def handle(self, *args, **options):
+        # command line policies override NOTIFICATION_RETENTION
+        policies = dict(retention.RETENTION)
+        for policy in ('archived', 'seen', 'per_user', 'queue', 'outbox'):
+            if options[policy] is not None:
+                policies[policy] = options[policy]
+
+        if options['dry_run']:
+            for policy in ('archived', 'seen', 'queue', 'outbox'):
+                if policies.get(policy) is not None:
+                    count = retention.expired(policy, policies[policy]).count()
+                    self.stdout.write('%s: %d rows to delete\n' % (policy, count))
+            return
+
+        deleted = retention.purge_all(policies, options['chunk_size'], options['pause'])
+        for policy, count in sorted(deleted.items()):
+            self.stdout.write('%s: deleted %d rows\n' % (policy, count))
@@ -0,0 +1,20 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from notification.backends.digest import send_digests
+
+
+class Command(BaseCommand):
+
+    help = 'emails every user with due digest notices one combined message'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None,
+                    help='number of users handled per query (default NOTIFICATION_DIGEST_CHUNK_SIZE)'),
+        make_option('--all', action='store_true', dest='force', default=False,
+                    help='also send digests that are not due yet'),
+    )
+
+    def handle(self, *args, **options):
+        sent = send_digests(options['chunk_size'], options['force'])
+        self.stdout.write('sent %d digests\n' % sent)
@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import ugettext_noop as _
 from notification import models as notification
@@ -7,12 +9,26 @@ from .. import create_notice_types
 class Command(BaseCommand):
 
     help = 'updates the database with the latest notice type definitions'
-  
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+                    help='only report the differences with NOTICE_TYPES, exit with '
+                         'an error if there are any'),
+        make_option('--prune', action='store_true', dest='prune', default=False,
+                    help='delete the notice types that are not in NOTICE_TYPES, '
+                         'with their notices and settings'),
+    )
+
     def handle(self, *args, **options):
-        create_notice_types()
-        
-        
-        
-        
-        
-        
+        verbosity = int(options.get('verbosity', 1))
+        if options['check']:
+            verbosity = max(verbosity, 2)
+        to_create, to_update, stale = create_notice_types(verbosity, options['check'],
+                                                          options['prune'])
+        if options['check'] and (to_create or to_update or (options['prune'] and stale)):
+            raise CommandError('notice types differ from NOTICE_TYPES')
+
+
+
+
+
+
@@ -0,0 +1,32 @@
+# Python Core
+import time
+
+# This app
+from notification.routers import PRIMARY_STICKY, pin_to_primary, unpin, has_written
+
+STICKY_COOKIE = "notification_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class PrimaryStickinessMiddleware(object):
+    '''
+    Reads the notification models of a request from the primary when it is
+    not a safe method or the user wrote in the last NOTIFICATION_PRIMARY_STICKY
+    seconds, see notification.routers.
+    '''
+
+    def process_request(self, request):
+        unpin()
+        try:
+            until = float(request.COOKIES.get(STICKY_COOKIE, 0))
+        except ValueError:
+            until = 0
+        if until > time.time() or request.method not in SAFE_METHODS:
+            pin_to_primary()
+
+    def process_response(self, request, response):
+        if PRIMARY_STICKY and (has_written() or request.method not in SAFE_METHODS):
+            response.set_cookie(STICKY_COOKIE, repr(time.time() + PRIMARY_STICKY),
+                                max_age=PRIMARY_STICKY)
+        unpin()
+        return response
@@ -1,5 +1,12 @@
+# Python Core
+import hashlib
+import logging
+import uuid
+from datetime import timedelta
+from itertools import islice
+
 # Django
-from django.db import models
+from django.db import models, router, transaction, IntegrityError
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import get_language, activate, ugettext_lazy as _
 from django.contrib.auth.models import User
@@ -12,12 +19,16 @@ from django.core.urlresolvers import resolve
 from django.dispatch import receiver
 from django.db.models.signals import pre_delete
 from django.db.models.query import QuerySet
+from django.utils import timezone
 
 # Django Apps
 from django.contrib.sites.models import Site
 
+# PickleField
+from picklefield.fields import PickledObjectField
+
 # This app
-from notification import backends
+from notification import backends, instrumentation, writebehind
 
 try:
     import cPickle as pickle
@@ -26,9 +37,29 @@ except ImportError:
 
 QUEUE_ALL = getattr(settings, "NOTIFICATION_QUEUE_ALL", False)
 THREAD_SEND_NOW = getattr(settings, "NOTIFICATION_THREAD_SEND_NOW", True)
+SEND_CHUNK_SIZE = getattr(settings, "NOTIFICATION_SEND_CHUNK_SIZE", 500)
+# Hours during which a repeated send with the same idempotency key is ignored.
+IDEMPOTENCY_TTL = getattr(settings, "NOTIFICATION_IDEMPOTENCY_TTL", 24)
+# Minutes a send_now that did not complete keeps its idempotency key; the
+# process may have died, a retry takes the key over after that.
+IDEMPOTENCY_LEASE = getattr(settings, "NOTIFICATION_IDEMPOTENCY_LEASE", 60)
+# Queued notices are split by recipient into this many partitions, see
+# notification.engine.
+QUEUE_PARTITIONS = getattr(settings, "NOTIFICATION_QUEUE_PARTITIONS", 1)
+# Record the deliveries of the non website backends in the outbox instead of
+# delivering them during send_now, see notification.outbox.
+OUTBOX = getattr(settings, "NOTIFICATION_OUTBOX", False)
+# Most recipients a queued batch holds; bigger queue() calls write several.
+QUEUE_BATCH_SIZE = getattr(settings, "NOTIFICATION_QUEUE_BATCH_SIZE", 5000)
+# The User columns loaded when recipients are given as a QuerySet, None for
+# all of them. Templates reading other columns cost a query per recipient.
+RECIPIENT_FIELDS = getattr(settings, "NOTIFICATION_RECIPIENT_FIELDS",
+                           ("username", "email", "first_name", "last_name", "is_active"))
 current_site = Site.objects.get_current()
 root_url = "http://%s" % unicode(current_site)
 
+logger = logging.getLogger(__name__)
+
 class NoticeType(models.Model):
     '''
     Stores a Notice class. Every notification sent out must belong to a
@@ -40,6 +71,8 @@ class NoticeType(models.Model):
     # The nitice of this type will only get sent using a medium with span
     # sensitivity less than or equal than this number.
     default = models.IntegerField(_("default"))
+    # Queued notices of types with a higher priority are sent first.
+    priority = models.IntegerField(_("priority"), default=0)
 
     def __unicode__(self):
         return self.label
@@ -55,19 +88,37 @@ NOTIFICATION_BACKENDS = backends.load_backends()
 NOTICE_MEDIA = [key for key in NOTIFICATION_BACKENDS.keys()]
 NOTICE_MEDIA_DEFAULTS = {key[0]: backend.spam_sensitivity for key, backend in
                                                  NOTIFICATION_BACKENDS.items()}
+website = None
 for key in NOTIFICATION_BACKENDS.keys():
     if key[1] == 'website':
         website = NOTIFICATION_BACKENDS[key]
         from notification.backends.website import Notice
 
-def create_notice_type(label, display, description, default=2, verbosity=1):
+
+def default_send(medium, notice_type):
+    '''
+    Returns whether users who did not change their settings get notices of
+    notice_type with medium: the notice type's default is at least the
+    medium's spam sensitivity. Media whose sensitivity is None, like the
+    digest, are opt-in.
+    '''
+    sensitivity = NOTICE_MEDIA_DEFAULTS[medium]
+    return sensitivity is not None and sensitivity <= notice_type.default
+
+
+def create_notice_type(label, display, description, default=2, verbosity=1,
+                       priority=None):
     '''
     Creates a new NoticeType.
     Intended to be used by other apps as a post_syncdb manangement step.
+    The priority of an existing type is only changed if one is given.
     '''
     try:
         notice_type = NoticeType.objects.get(label=label)
         updated = False
+        if priority is not None and priority != notice_type.priority:
+            notice_type.priority = priority
+            updated = True
         if display != notice_type.display:
             notice_type.display = display
             updated = True
@@ -85,7 +136,8 @@ def create_notice_type(label, display, description, default=2, verbosity=1):
         NoticeType(label=label,
                    display=display,
                    description=description,
-                   default=default).save()
+                   default=default,
+                   priority=priority or 0).save()
         if verbosity > 0:
             print "Created %s NoticeType" % label
 
@@ -107,21 +159,140 @@ class NoticeSetting(models.Model):
         unique_together = ("user", "notice_type", "medium")
 
 
+class MediumMute(models.Model):
+    '''
+    Indicates that a user receives no notices at all using a given medium,
+    whatever their NoticeSetting rows say. Only muted media have a row.
+    '''
+
+    user = models.ForeignKey(User, verbose_name=_("user"))
+    medium = models.CharField(_("medium"), max_length=1, choices=NOTICE_MEDIA)
+    added = models.DateTimeField(_("added"), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("medium mute")
+        verbose_name_plural = _("medium mutes")
+        unique_together = ("user", "medium")
+
+
+def mute(user, medium):
+    '''
+    Stops every notice to user using medium, with a single INSERT.
+    '''
+    try:
+        sid = transaction.savepoint()
+        MediumMute.objects.create(user=user, medium=medium)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # already muted
+        transaction.savepoint_rollback(sid)
+
+
+def unmute(user, media):
+    '''
+    Lets user receive notices using media again, per their NoticeSettings.
+    '''
+    MediumMute.objects.filter(user=user, medium__in=[unicode(medium) for medium in media]).delete()
+
+
+def get_muted_media(users):
+    '''
+    Returns the (user id, medium) pairs users muted, with the medium id as
+    unicode; one query.
+    '''
+    return set(MediumMute.objects.filter(user__in=[user.pk for user in users])
+                                 .values_list("user_id", "medium"))
+
+
+def is_muted(user, medium):
+    prefetched = getattr(user, "_muted_media", None)
+    if prefetched is not None:
+        return (user.pk, unicode(medium)) in prefetched
+    return MediumMute.objects.filter(user=user, medium=medium).exists()
+
+
+def get_notification_settings(users, notice_types):
+    '''
+    Returns the NoticeSetting of each of users for each of notice_types and
+    every medium, keyed by (user id, notice type id, medium) with the medium
+    id as unicode, the way the column holds it. The missing settings are
+    created with their defaults; three queries at most, four when reading
+    from a replica.
+    '''
+    user_ids = [user.pk for user in users]
+    type_ids = [notice_type.pk for notice_type in notice_types]
+    found = {}
+    query = NoticeSetting.objects.filter(user__in=user_ids, notice_type__in=type_ids)
+    read_from = query.db
+    for setting in query.using(read_from):
+        found[(setting.user_id, setting.notice_type_id, setting.medium)] = setting
+    missing = [NoticeSetting(user_id=user_id, notice_type_id=notice_type.pk, medium=medium,
+                             send=default_send(medium, notice_type))
+               for user_id in user_ids
+               for notice_type in notice_types
+               for medium, medium_display in NOTICE_MEDIA
+               if (user_id, notice_type.pk, unicode(medium)) not in found]
+    if missing:
+        primary = router.db_for_write(NoticeSetting, lookup=True)
+        if read_from != primary:
+            # the settings were read from a replica that may be behind
+            for setting in query.using(primary):
+                found[(setting.user_id, setting.notice_type_id, setting.medium)] = setting
+            missing = [setting for setting in missing if (setting.user_id,
+                       setting.notice_type_id, unicode(setting.medium)) not in found]
+    if missing:
+        NoticeSetting.objects.bulk_create(missing)
+        # read back for their ids
+        for setting in query.using(primary):
+            found[(setting.user_id, setting.notice_type_id, setting.medium)] = setting
+    return found
+
+
+def prefetch_notification_settings(users, notice_type):
+    '''
+    Loads the mutes and the settings of users for notice_type at once;
+    should_send then answers for them without a query, until
+    clear_notification_settings. Returns the users that did not mute every
+    medium, whose settings are not loaded.
+    '''
+    muted = get_muted_media(users)
+    if muted:
+        users = [user for user in users if not all(
+            (user.pk, unicode(medium)) in muted for medium, medium_display in NOTICE_MEDIA)]
+    found = get_notification_settings(users, [notice_type]) if users else {}
+    for user in users:
+        user._muted_media = muted
+        user._notification_settings = found
+    return users
+
+
+def clear_notification_settings(users):
+    for user in users:
+        user.__dict__.pop("_muted_media", None)
+        user.__dict__.pop("_notification_settings", None)
+
+
 def get_notification_setting(user, notice_type, medium):
+    prefetched = getattr(user, "_notification_settings", {})
+    key = (user.pk, notice_type.pk, unicode(medium))
+    if key in prefetched:
+        return prefetched[key]
     try:
         return NoticeSetting.objects.get(user=user,
                                          notice_type=notice_type,
                                          medium=medium)
     except NoticeSetting.DoesNotExist:
-        send = NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default
-
-        return NoticeSetting.objects.create(user=user,
-                                            notice_type=notice_type,
-                                            medium=medium,
-                                            send=send)
+        send = default_send(medium, notice_type)
+        # get_or_create looks on the primary, the get may have read a replica
+        return NoticeSetting.objects.get_or_create(user=user,
+                                                   notice_type=notice_type,
+                                                   medium=medium,
+                                                   defaults={"send": send})[0]
 
 
 def should_send(user, notice_type, medium):
+    if is_muted(user, medium):
+        return False
     return get_notification_setting(user, notice_type, medium).send
 
 
@@ -147,12 +318,115 @@ def get_notification_language(user):
     raise LanguageStoreNotAvailable
 
 
+def get_notification_languages(users):
+    '''
+    Returns a dictionary of user id to notification language for the given
+    users, using a single query. Users without a stored language are left
+    out. Raises LanguageStoreNotAvailable like get_notification_language.
+    '''
+    if getattr(settings, "NOTIFICATION_LANGUAGE_MODULE", False):
+        try:
+            app_lbl, model_nm = settings.NOTIFICATION_LANGUAGE_MODULE.split(".")
+            model = models.get_model(app_lbl, model_nm)
+            language_models = model._default_manager.filter(
+                                    user__id__in=[user.id for user in users])
+            return dict((language_model.user_id, language_model.language)
+                        for language_model in language_models
+                        if hasattr(language_model, "language"))
+        except (ImportError, ImproperlyConfigured, AttributeError, ValueError):
+            raise LanguageStoreNotAvailable
+    raise LanguageStoreNotAvailable
+
+
+def chunked(items, size):
+    '''
+    Yields lists of at most size items from any iterable.
+    '''
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream(queryset, size, pk_of=lambda obj: obj.pk):
+    '''
+    Yields lists of at most size rows of queryset in primary key order, one
+    query each, starting after the last primary key of the previous list.
+    Nothing is cached, so memory stays flat whatever the number of rows.
+    pk_of returns the primary key of a row. A sliced queryset, which can not
+    be filtered any more, is iterated once instead.
+    '''
+    if queryset.query.low_mark or queryset.query.high_mark is not None:
+        for chunk in chunked(queryset.iterator(), size):
+            yield chunk
+        return
+    queryset = queryset.order_by("pk")
+    last_pk = None
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(page[:size].iterator())
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        last_pk = pk_of(chunk[-1])
+
+
+def recipient_chunks(users, size):
+    '''
+    Yields lists of at most size users. A QuerySet is streamed, loading only
+    NOTIFICATION_RECIPIENT_FIELDS unless it already defers fields.
+    '''
+    if not isinstance(users, QuerySet):
+        return chunked(users, size)
+    if RECIPIENT_FIELDS and users.query.deferred_loading == (set(), True):
+        users = users.only(*RECIPIENT_FIELDS)
+    return stream(users, size)
+
+
+class NoTransaction(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def chunk_transaction():
+    '''
+    Returns a context manager committing the writes for a chunk of recipients
+    together, unless the caller manages the transaction.
+    '''
+    if transaction.is_managed():
+        return NoTransaction()
+    return transaction.commit_on_success()
+
+
+def group_by_language(users):
+    '''
+    Returns (language, users) pairs for a chunk of users, looking up all of
+    their languages at once. Users without a language are grouped under None.
+    '''
+    try:
+        languages = get_notification_languages(users)
+    except LanguageStoreNotAvailable:
+        return [(None, users)]
+    groups = {}
+    for user in users:
+        groups.setdefault(languages.get(user.id), []).append(user)
+    return groups.items()
+
+
 def broadcast(label, extra_context=None, sender=None, exclude=None):
     '''Brodcasts a notification for all the users on the system.'''
 
     extra_context = extra_context or {}
     exclude = exclude or []
-    send_to = set(User.objects.all()) - set(exclude)
+    # a QuerySet, so the users are streamed rather than all loaded
+    send_to = User.objects.exclude(pk__in=[user.pk for user in exclude])
 
     send(send_to, label, extra_context, sender)
 
@@ -191,10 +465,18 @@ def send(*args, **kwargs):
     flag NOTIFICATION_QUEUE_ALL that helps determine whether all calls should
     be queued or not. A per call ``queue`` or ``now`` keyword argument can be
     used to always override the default global behavior.
+
+    A ``deliver_at`` datetime or a ``delay`` timedelta keyword argument
+    schedules the notice, see queue. An ``idempotency_key`` keyword argument
+    is passed on to queue or send_now.
     """
     queue_flag = kwargs.pop("queue", False)
     now_flag = kwargs.pop("now", False)
     assert not (queue_flag and now_flag), "'queue' and 'now' cannot both be True."
+    if kwargs.get("deliver_at") or kwargs.get("delay"):
+        return queue(*args, **kwargs)
+    kwargs.pop("deliver_at", None)
+    kwargs.pop("delay", None)
     if queue_flag:
         return queue(*args, **kwargs)
     else:
@@ -219,27 +501,241 @@ class NoticeQueueBatch(models.Model):
     Denormalized data for a notice.
     """
     pickled_data = models.TextField()
+    # set once the batch was sent, see notification.engine
+    processed = models.DateTimeField(_("processed"), null=True, blank=True, db_index=True)
+    # a worker claiming the batch leases it until then; a batch whose send
+    # failed or whose worker died is retried once its lease ran out
+    leased_until = models.DateTimeField(_("leased until"), null=True, blank=True)
+    # the number of times the batch was claimed
+    attempts = models.PositiveSmallIntegerField(_("attempts"), default=0)
+    # the priority of the notice type, batches are sent highest first
+    priority = models.IntegerField(_("priority"), default=0)
+    # all the batch's recipients are in this partition, see partition_for
+    partition = models.PositiveSmallIntegerField(_("partition"), default=0)
+
+    class Meta:
+        index_together = [["processed", "partition", "priority"]]
+
+
+class ScheduledBatch(models.Model):
+    """
+    Queued notices not to be sent before due. The queue consumer moves them
+    to NoticeQueueBatch once due, see notification.engine.
+    """
+    pickled_data = models.TextField()
+    due = models.DateTimeField(_("due"), db_index=True)
+    priority = models.IntegerField(_("priority"), default=0)
+    partition = models.PositiveSmallIntegerField(_("partition"), default=0)
+
+
+class DeliveryPayload(models.Model):
+    """
+    The part of the context of a send shared by all its outbox deliveries,
+    see recipient_context.
+    """
+    data = PickledObjectField()
+    content_type = models.ForeignKey(ContentType, null=True, blank=True)
+    object_id = models.PositiveIntegerField(null=True, blank=True)
+    sender = generic.GenericForeignKey("content_type", "object_id")
+    sender_path = models.TextField(blank=True)
+    added = models.DateTimeField(_("added"), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("delivery payload")
+        verbose_name_plural = _("delivery payloads")
+
+
+class Delivery(models.Model):
+    """
+    A notice waiting in the outbox to be delivered to one recipient by one
+    backend, see notification.outbox. Website notices are saved during the
+    send and recorded as sent, so a send repeating its send_key skips them.
+    """
+    PENDING = 0
+    SENT = 1
+    DEAD = 2
+    STATUS_CHOICES = (
+        (PENDING, _("pending")),
+        (SENT, _("sent")),
+        (DEAD, _("dead")),
+    )
+
+    recipient = models.ForeignKey(User, verbose_name=_("recipient"))
+    notice_type = models.ForeignKey(NoticeType, verbose_name=_("notice type"))
+    medium = models.CharField(_("medium"), max_length=1, choices=NOTICE_MEDIA)
+    # the send_now call, the deliveries of a send share their rendering
+    send_key = models.CharField(_("send key"), max_length=32)
+    payload = models.ForeignKey(DeliveryPayload, null=True, blank=True)
+    # the website notice of the send to the recipient, if any
+    notice_id = models.PositiveIntegerField(_("notice id"), null=True, blank=True)
+    # the whole context, for the deliveries recorded before payloads
+    data = PickledObjectField(null=True)
+    status = models.PositiveSmallIntegerField(_("status"), choices=STATUS_CHOICES,
+                                              default=PENDING)
+    # the priority of the notice type, due deliveries are sent highest first
+    priority = models.IntegerField(_("priority"), default=0)
+    attempts = models.PositiveSmallIntegerField(_("attempts"), default=0)
+    # time of the next attempt
+    due = models.DateTimeField(_("due"))
+    added = models.DateTimeField(_("added"), auto_now_add=True)
+    sent = models.DateTimeField(_("sent"), null=True, blank=True)
+    last_error = models.TextField(_("last error"), blank=True)
+
+    def __unicode__(self):
+        return u"%s to %s" % (self.notice_type, self.recipient)
+
+    class Meta:
+        verbose_name = _("delivery")
+        verbose_name_plural = _("deliveries")
+        index_together = [["status", "due"], ["status", "priority", "due"]]
+        unique_together = ("send_key", "recipient", "medium")
             
 
-def queue(users, label, extra_context=None, on_site=True, sender=None):
+def queue(users, label, extra_context=None, on_site=True, sender=None,
+          deliver_at=None, delay=None, idempotency_key=None):
     """
     Queue the notification in NoticeQueueBatch. This allows for large amounts
     of user notifications to be deferred to a seperate process running outside
     the webserver.
+
+    With deliver_at (a datetime) or delay (a timedelta from now) the
+    notification is kept in ScheduledBatch until then.
+
+    A call repeating the idempotency_key of an earlier one for the same
+    notice type and users does nothing, see claim_idempotency_key. The key
+    and all the batches are then committed together, so a failed call may
+    be retried with the same key.
     """
     if extra_context is None:
         extra_context = {}
     if isinstance(users, QuerySet):
-        users = [row["pk"] for row in users.values("pk")]
+        user_pks = users.values_list("pk", flat=True)
     else:
-        users = [user.pk for user in users]
-    notices = []
-    for user in users:
-        notices.append((user, label, extra_context, on_site, sender))
-    NoticeQueueBatch(pickled_data=pickle.dumps(notices).encode("base64")).save()
+        user_pks = [user.pk for user in users]
+    if idempotency_key is None:
+        return queue_batches(user_pks, label, extra_context, on_site, sender,
+                             deliver_at, delay)
+    # the key covers every recipient, they are all read first
+    user_pks = list(user_pks)
+    with chunk_transaction():
+        claimed = claim_idempotency_key(idempotency_key, label, user_pks)
+        if claimed is None:
+            return
+        queue_batches(user_pks, label, extra_context, on_site, sender, deliver_at, delay)
+        complete_idempotency_key(claimed.digest)
+
+
+def queue_batches(user_pks, label, extra_context, on_site, sender, deliver_at, delay):
+    '''
+    Writes the queue batches of queue, a transaction per QUEUE_BATCH_SIZE
+    recipients unless the caller manages the transaction.
+    '''
+    if isinstance(user_pks, QuerySet):
+        chunks = stream(user_pks, QUEUE_BATCH_SIZE, pk_of=lambda pk: pk)
+    else:
+        chunks = chunked(user_pks, QUEUE_BATCH_SIZE)
+    priority = NoticeType.objects.filter(label=label).values_list("priority", flat=True)
+    priority = priority[0] if priority else 0
+    if delay is not None:
+        deliver_at = timezone.now() + delay
+    for chunk in chunks:
+        partitions = {}
+        for user_pk in chunk:
+            partitions.setdefault(partition_for(user_pk), []).append(
+                (user_pk, label, extra_context, on_site, sender))
+        # one batch per partition, so each is sent by the worker owning it
+        with chunk_transaction():
+            for partition, notices in sorted(partitions.items()):
+                pickled_data = pickle.dumps(notices).encode("base64")
+                if deliver_at is not None:
+                    ScheduledBatch(pickled_data=pickled_data, due=deliver_at,
+                                   priority=priority, partition=partition).save()
+                else:
+                    NoticeQueueBatch(pickled_data=pickled_data, priority=priority,
+                                     partition=partition).save()
+
+
+class IdempotencyKey(models.Model):
+    """
+    A send made with an idempotency key, see claim_idempotency_key.
+    """
+    # digest of the caller's key, the notice type and the recipients
+    digest = models.CharField(_("digest"), max_length=40, unique=True)
+    added = models.DateTimeField(_("added"), db_index=True)
+    # set once every notice of the send was sent or queued
+    completed = models.BooleanField(_("completed"), default=False)
+    # the last recipient of the last chunk send_now committed, a retry of a
+    # failed send resumes after it
+    last_recipient = models.PositiveIntegerField(_("last recipient"), null=True, blank=True)
+
+
+def idempotency_digest(key, label, user_pks):
+    '''
+    Returns the digest identifying a send by its idempotency key, notice type
+    and recipients.
+    '''
+    return hashlib.sha1("%s\0%s\0%s" % (key, label, ",".join(
+        str(pk) for pk in sorted(set(user_pks))))).hexdigest()
 
 
-def send_now(users, label, extra_context=None, sender=None):
+def claim_idempotency_key(key, label, user_pks):
+    '''
+    Records a send with the given idempotency key. Returns its
+    IdempotencyKey, whose digest is passed to complete_idempotency_key once
+    the send succeeded or to release_idempotency_key when it failed. Returns
+    None when the send must be skipped: the same key was used for the same
+    notice type and recipients less than NOTIFICATION_IDEMPOTENCY_TTL hours
+    ago by a send that completed, or less than NOTIFICATION_IDEMPOTENCY_LEASE
+    minutes ago by one that may still be running.
+
+    The key of a send that failed or died is taken over with its
+    last_recipient, for the retry to resume after it; an expired key starts
+    over.
+    '''
+    digest = idempotency_digest(key, label, user_pks)
+    now = timezone.now()
+    try:
+        sid = transaction.savepoint()
+        claimed = IdempotencyKey.objects.create(digest=digest, added=now)
+        transaction.savepoint_commit(sid)
+        return claimed
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+    # taken over by the first caller to refresh it
+    keys = IdempotencyKey.objects.filter(digest=digest)
+    expired = now - timedelta(hours=IDEMPOTENCY_TTL)
+    abandoned = now - timedelta(minutes=IDEMPOTENCY_LEASE)
+    if (keys.filter(added__lt=expired).update(added=now, completed=False, last_recipient=None) or
+            keys.filter(completed=False, added__lt=abandoned).update(added=now)):
+        return keys.get()
+    return None
+
+
+def complete_idempotency_key(digest):
+    IdempotencyKey.objects.filter(digest=digest).update(completed=True)
+
+
+def release_idempotency_key(digest):
+    '''
+    Ends the lease of a send that failed, so the caller may retry it at once;
+    the retry resumes after the last chunk the send committed. Within a
+    transaction of the caller the claim goes away with its rollback.
+    '''
+    if not transaction.is_managed():
+        IdempotencyKey.objects.filter(digest=digest, completed=False).update(
+            added=timezone.now() - timedelta(minutes=IDEMPOTENCY_LEASE))
+
+
+def partition_for(user_pk):
+    '''
+    Returns the queue partition of a recipient. All the queued notices of a
+    user are in the same partition, so they are sent by one worker; not in
+    the order they were queued, see notification.engine.send_all.
+    '''
+    return int(user_pk) % QUEUE_PARTITIONS
+
+
+def send_now(users, label, extra_context=None, sender=None, idempotency_key=None):
     '''
     Creates a new notice.
         This is intended to be how other apps create new notices:
@@ -248,63 +744,201 @@ def send_now(users, label, extra_context=None, sender=None):
     sender: should always be the object of interest to the users(recipiants)
         Example 1:  if a user is followed the sender should be the following user.
         Example 2:  if a blog entry is commented on the sender should be the blog entry.
+
+    idempotency_key: a call repeating the key of an earlier one for the same
+        notice type and users does nothing, see claim_idempotency_key. The
+        key is only kept once the send succeeded, so a failed call may be
+        retried with the same key. The retry resumes after the last chunk
+        of recipients the failed call committed.
+    '''
+    if idempotency_key is None:
+        return fan_out(users, label, extra_context, sender, uuid.uuid4().hex)
+    if isinstance(users, QuerySet) and not users.query.low_mark and users.query.high_mark is None:
+        user_pks = list(users.values_list("pk", flat=True))
+    else:
+        # in primary key order, as a QuerySet is streamed, for a retry to
+        # resume after the last recipient committed
+        users = sorted(users, key=lambda user: user.pk)
+        user_pks = [user.pk for user in users]
+    claimed = claim_idempotency_key(idempotency_key, label, user_pks)
+    if claimed is None:
+        return
+    try:
+        # a repeated send skips the recipients it already recorded in the outbox
+        fan_out(users, label, extra_context, sender, claimed.digest[:32], claimed)
+    except Exception:
+        release_idempotency_key(claimed.digest)
+        raise
+    complete_idempotency_key(claimed.digest)
+
+
+def fan_out(users, label, extra_context, sender, send_key, idempotency_key=None):
+    '''
+    Sends the notice to users for send_now, send_key identifying the send in
+    the outbox. With the IdempotencyKey of the send, users are in primary key
+    order and the last recipient of every chunk is committed with the chunk.
     '''
-    
     notice_type = NoticeType.objects.get(label=label)
     current_language = get_language()
     extra_context = extra_context or {}
-    notices_url = root_url + reverse("notification_notices")
     sender_path = get_sender_path(extra_context, sender)
-   
-    for user in users:
-        try:
-            activate(get_notification_language(user))
-        except LanguageStoreNotAvailable:
-            pass
+    if website and sender_path:
+        #save sender_path to website db
+        extra_context.update({"sender_path": sender_path})
+    # rendered fragments that do not depend on the recipient, per language
+    fragments = {}
+    # website notices of sends to several users share their extra context
+    payload = None
+    # and so do outbox deliveries
+    delivery_payload = None
+    # website notices are buffered only when each chunk commits on its own,
+    # see notification.writebehind
+    write_behind = writebehind.WRITE_BEHIND and not transaction.is_managed()
+    if idempotency_key is not None and idempotency_key.last_recipient is not None:
+        # the chunks an earlier attempt of the send committed
+        if isinstance(users, QuerySet):
+            users = users.filter(pk__gt=idempotency_key.last_recipient)
+        else:
+            users = [user for user in users if user.pk > idempotency_key.last_recipient]
 
-        # generate unsubscribe link    
-        signer = Signer()
-        args = ['email', signer.sign(user.pk)]
-        unsub_url = root_url + reverse('notificaton_unsubscribe', args=args)
-
-        # update context with user specific translations
-        context = {
-            "recipient": user,
-            "sender": sender,
-            "notice": notice_type,
-            "notices_url": notices_url,
-            "root_url": root_url,
-            "current_site": current_site,
-            "unsubscribe_link": unsub_url,
-        }
-
-        #if website backend is present add context and save sender_path if provided.
-        if website and website.can_send(user, notice_type):
-            if sender_path:
-                #save sender_path to website db
-                extra_context.update({"sender_path":sender_path})
-            website.deliver(user, sender, notice_type, extra_context)
-            #website specific context
-            #make sender_url with view_sender (TODO: this may be unreliable, may need signal after saved)
-            notice = Notice.objects.latest('added')
-            extra_context.update({"sender_url":root_url+notice.get_sender_url()})
-            extra_context.update(notice.get_context())
+    # a QuerySet is streamed, each chunk is committed on its own
+    for chunk in recipient_chunks(users, SEND_CHUNK_SIZE):
+        deferred = []
+        last_recipient = chunk[-1].pk
+        with chunk_transaction():
+            deliveries = []
+            instrumentation.count("recipients", notice_type=notice_type, n=len(chunk))
+            with instrumentation.timer("settings", notice_type=notice_type):
+                # the recipients who muted every medium are dropped
+                chunk = prefetch_notification_settings(chunk, notice_type)
+            # recipients this send already recorded in the outbox
+            done = set()
+            if OUTBOX:
+                done = set(Delivery.objects.filter(send_key=send_key,
+                                                   recipient__in=[user.pk for user in chunk])
+                                           .values_list("recipient_id", flat=True))
+            for language, group in group_by_language(chunk):
+                activate(language or current_language)
+                for user in group:
+                    if user.pk in done:
+                        continue
+                    done.add(user.pk)
 
-        #if website is not present provide sender_url without view_sender.
-        else:
-            extra_context.update({"notice_id": False, "sender_url": root_url+sender_path})
-        
-        #add context that we did not want to get saved in website db
-        extra_context.update(context)
-            
-        for backend in NOTIFICATION_BACKENDS.values():
-            if backend.can_send(user, notice_type) and backend != website:
-                backend.deliver(user, sender, notice_type, extra_context)
+                    notice = None
+                    if website and website.can_send(user, notice_type):
+                        if payload is None and len(chunk) > 1:
+                            payload = website.create_payload(extra_context)
+                        # with the outbox, where the other backends only queue
+                        # deliveries, a failing website notice neither stops
+                        # the send nor the other backends. Without it a failure
+                        # stops the send like a failing email does, and no
+                        # savepoint is paid for per recipient.
+                        sid = transaction.savepoint() if OUTBOX else None
+                        try:
+                            with instrumentation.timer("website", website, notice_type):
+                                notice = website.deliver(user, sender, notice_type, extra_context,
+                                                         payload=payload, defer=write_behind)
+                            if sid:
+                                transaction.savepoint_commit(sid)
+                        except Exception:
+                            if sid is None:
+                                raise
+                            transaction.savepoint_rollback(sid)
+                            logger.exception("website notice to user %s failed", user.pk)
+                            instrumentation.count("failed", website, notice_type)
+                        else:
+                            instrumentation.count("website", website, notice_type)
+                            if notice is None:
+                                notice = Notice.objects.latest('added')
+                            if OUTBOX:
+                                deliveries.append(Delivery(recipient=user,
+                                                           notice_type=notice_type,
+                                                           medium=website.medium_id,
+                                                           send_key=send_key,
+                                                           priority=notice_type.priority,
+                                                           notice_id=notice.pk,
+                                                           status=Delivery.SENT,
+                                                           due=timezone.now(),
+                                                           sent=timezone.now()))
+                            # a coalesced notice was already sent by the other
+                            # backends within the coalescing window
+                            if getattr(notice, 'coalesced', False):
+                                continue
+                            if notice.pk is None:
+                                # saved once the chunk is committed
+                                deferred.append(notice)
+                                notice = None
+
+                    context = recipient_context(user, sender, notice_type, extra_context,
+                                                sender_path, notice)
+                    # recipients with and without a website notice do not
+                    # share the same context keys
+                    context[backends.FRAGMENTS_KEY] = fragments.setdefault(
+                        (language, notice is not None), {})
+
+                    for backend in NOTIFICATION_BACKENDS.values():
+                        if backend.can_send(user, notice_type) and backend != website:
+                            if OUTBOX:
+                                if delivery_payload is None:
+                                    delivery_payload = DeliveryPayload.objects.create(
+                                        data=extra_context, sender=sender,
+                                        sender_path=sender_path or "")
+                                deliveries.append(Delivery(recipient=user,
+                                                           notice_type=notice_type,
+                                                           medium=backend.medium_id,
+                                                           send_key=send_key,
+                                                           priority=notice_type.priority,
+                                                           payload=delivery_payload,
+                                                           notice_id=notice and notice.pk,
+                                                           due=timezone.now()))
+                            else:
+                                with instrumentation.timer("deliver", backend, notice_type):
+                                    backend.deliver(user, sender, notice_type, context)
+                                instrumentation.count("deliver", backend, notice_type)
+            if deliveries:
+                with instrumentation.timer("outbox", notice_type=notice_type):
+                    Delivery.objects.bulk_create(deliveries)
+                instrumentation.count("outbox", notice_type=notice_type, n=len(deliveries))
+            if idempotency_key is not None:
+                IdempotencyKey.objects.filter(pk=idempotency_key.pk).update(
+                    last_recipient=last_recipient)
+            clear_notification_settings(chunk)
+        if deferred:
+            writebehind.buffer.add(deferred)
 
     # reset environment to original language
     activate(current_language)
 
 
+def recipient_context(user, sender, notice_type, extra_context, sender_path, notice=None):
+    '''
+    Returns the context the backends other than website are given for user:
+    extra_context with the recipient's links, and the context of their
+    website notice of the send if there is one.
+    '''
+    context = dict(extra_context)
+    if notice is not None:
+        #website specific context
+        #make sender_url with view_sender
+        context.update({"sender_url": root_url+notice.get_sender_url(sender_path)})
+        context.update(notice.get_context())
+    else:
+        #if website is not present provide sender_url without view_sender.
+        context.update({"notice_id": False, "sender_url": root_url+sender_path})
+    # generate unsubscribe link
+    args = ['email', Signer().sign(user.pk)]
+    context.update({
+        "recipient": user,
+        "sender": sender,
+        "notice": notice_type,
+        "notices_url": root_url + reverse("notification_notices"),
+        "root_url": root_url,
+        "current_site": current_site,
+        "unsubscribe_link": root_url + reverse('notificaton_unsubscribe', args=args),
+    })
+    return context
+
+
 class ObservedItemManager(models.Manager):
 
     def observers(self, observed, label):
@@ -407,12 +1041,19 @@ def send_observation_notices_for(observed, label, xcontext=None, exclude=None, s
     '''
     xcontext = xcontext or {}
     exclude = exclude or []
-    sent = []
-    observations = Observation.objects.observers(observed, label)
-    for observation in observations:
-        if observation.user not in exclude:
-            observation.send_notice(xcontext, sender=sender)
-            sent.append(observation.user)
+    observations = [observation for observation in
+                    Observation.objects.observers(observed, label).select_related("user")
+                    if observation.user not in exclude]
+    sent = [observation.user for observation in observations]
+    # the observers who turned the notices off are only returned
+    recipients = [observation.user for observation in observations if observation.send]
+    if recipients:
+        # every observer gets the same notice, sent in one go
+        if not sender:
+            sender = observed
+            xcontext.update({"alter_desc": True})
+        xcontext.update({"observed": observed})
+        send(recipients, label, xcontext, sender=sender)
     # Return list of recipiants for exclusion from additional notifications.
     return sent
 
@@ -438,12 +1079,13 @@ def get_observations(observer, observed_type, labels):
     if not isinstance(labels, list):
         labels = [labels]
     elements = set()
-    for label in labels:
-        content_type = ContentType.objects.get_for_model(observed_type)
-        for x in Observation.objects.filter(user=observer,
-                                            notice_type__label__in=labels,
-                                            content_type=content_type):
-            elements.add(x.observed_object)
+    content_type = ContentType.objects.get_for_model(observed_type)
+    observations = Observation.objects.filter(user=observer,
+                                              notice_type__label__in=labels,
+                                              content_type=content_type)
+    # the observed objects are loaded with one query
+    for x in observations.prefetch_related("observed_object"):
+        elements.add(x.observed_object)
     return list(elements)
 
 '''
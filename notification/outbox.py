@@ -0,0 +1,272 @@
+'''
+Delivery outbox.
+
+With NOTIFICATION_OUTBOX( = False) set, send_now still saves the website
+notices right away but only records a Delivery for every other backend a
+recipient gets the notice by. The deliver_notices management command sends
+them later, so a slow or failing backend neither holds up the request nor
+the other backends.
+
+A delivery that fails is retried after NOTIFICATION_OUTBOX_BACKOFF( = 60)
+seconds, doubling the wait after every attempt. After
+NOTIFICATION_OUTBOX_MAX_ATTEMPTS( = 5) attempts it is marked dead and left
+for inspection in the admin. Sent deliveries are kept until purge_notices
+removes them (the "outbox" retention policy).
+
+Every backend is a lane of its own: send_lanes drains them at the same time,
+each with the number of worker threads and the chunk size configured in
+NOTIFICATION_OUTBOX_LANES( = {}), keyed by backend label:
+    NOTIFICATION_OUTBOX_LANES = {"email": {"workers": 4, "chunk_size": 20}}
+so a throttled email relay does not hold up the other backends. lane_stats
+reports the depth and lag of every lane.
+'''
+# Python Core
+import logging
+import threading
+import traceback
+from datetime import timedelta
+
+# Django
+from django.conf import settings
+from django.db import connection, router
+from django.db.models import Count, Min
+from django.utils import timezone
+from django.utils.translation import get_language, activate
+
+# This app
+from notification import backends, instrumentation
+from notification.engine import fair_turn
+from notification.models import (Delivery, DeliveryPayload, NOTIFICATION_BACKENDS,
+                                 get_notification_languages, recipient_context,
+                                 LanguageStoreNotAvailable)
+
+OUTBOX_BACKOFF = getattr(settings, "NOTIFICATION_OUTBOX_BACKOFF", 60)
+OUTBOX_MAX_ATTEMPTS = getattr(settings, "NOTIFICATION_OUTBOX_MAX_ATTEMPTS", 5)
+# seconds a worker has to deliver what it claimed before others may retry it
+OUTBOX_LEASE = getattr(settings, "NOTIFICATION_OUTBOX_LEASE", 300)
+OUTBOX_CHUNK_SIZE = getattr(settings, "NOTIFICATION_OUTBOX_CHUNK_SIZE", 100)
+OUTBOX_LANES = getattr(settings, "NOTIFICATION_OUTBOX_LANES", {})
+
+logger = logging.getLogger(__name__)
+
+
+def get_backend(medium):
+    for key, backend in NOTIFICATION_BACKENDS.items():
+        if str(key[0]) == str(medium):
+            return backend
+    return None
+
+
+def claim(delivery, lease_until):
+    '''
+    Postpones a due delivery by the lease unless another worker already did.
+    Returns True when the delivery is ours to send.
+    '''
+    return Delivery.objects.filter(id=delivery.id,
+                                   status=Delivery.PENDING,
+                                   due=delivery.due
+                                   ).update(due=lease_until) == 1
+
+
+def backoff(attempts):
+    '''
+    Returns the wait before the next attempt of a delivery that failed
+    attempts times.
+    '''
+    return timedelta(seconds=OUTBOX_BACKOFF * 2 ** (attempts - 1))
+
+
+def failed(delivery):
+    delivery.attempts += 1
+    delivery.last_error = traceback.format_exc()
+    if delivery.attempts >= OUTBOX_MAX_ATTEMPTS:
+        delivery.status = Delivery.DEAD
+        logger.error("delivery %s is dead after %d attempts",
+                     delivery.id, delivery.attempts)
+    else:
+        delivery.due = timezone.now() + backoff(delivery.attempts)
+    delivery.save()
+
+
+def website_notices(deliveries):
+    '''
+    Returns the website notices of deliveries by id, with one query. Notices
+    deleted since the send are left out.
+    '''
+    ids = [delivery.notice_id for delivery in deliveries if delivery.notice_id]
+    if not ids:
+        return {}
+    # imported here, the website backend is optional
+    from notification.backends.website import Notice
+    # they may be too recent for a replica
+    notices = Notice.objects.using(router.db_for_write(Notice, lookup=True))
+    return notices.select_related("content_type").in_bulk(ids)
+
+
+def delivery_context(delivery, payloads, notices):
+    '''
+    Returns the context the backend of delivery is given, rebuilt from the
+    payload of its send and its recipient's website notice.
+    '''
+    if delivery.payload_id is None:
+        # recorded before payloads
+        return delivery.data
+    payload = payloads[delivery.payload_id]
+    return recipient_context(delivery.recipient, payload.sender, delivery.notice_type,
+                             payload.data, payload.sender_path,
+                             notices.get(delivery.notice_id))
+
+
+def deliver_chunk(deliveries):
+    '''
+    Delivers claimed deliveries, activating each recipient's language and
+    sharing the rendering of deliveries of the same send. Returns the number
+    of deliveries sent.
+    '''
+    try:
+        languages = get_notification_languages([d.recipient for d in deliveries])
+    except LanguageStoreNotAvailable:
+        languages = {}
+    payloads = DeliveryPayload.objects.using(router.db_for_write(DeliveryPayload, lookup=True)
+                                             ).in_bulk(set(delivery.payload_id
+                                                           for delivery in deliveries
+                                                           if delivery.payload_id))
+    notices = website_notices(deliveries)
+    current_language = get_language()
+    fragments = {}
+    sent_ids = []
+    for delivery in deliveries:
+        language = languages.get(delivery.recipient_id)
+        activate(language or current_language)
+        backend = None
+        try:
+            context = delivery_context(delivery, payloads, notices)
+            key = (delivery.send_key, language, bool(context.get("notice_id")))
+            context[backends.FRAGMENTS_KEY] = fragments.setdefault(key, {})
+            backend = get_backend(delivery.medium)
+            if backend is None:
+                raise LookupError("no backend for medium %s" % delivery.medium)
+            with instrumentation.timer("deliver", backend, delivery.notice_type):
+                backend.deliver(delivery.recipient, context.get("sender"),
+                                delivery.notice_type, context)
+        except Exception:
+            logger.exception("delivery %s failed", delivery.id)
+            failed(delivery)
+            instrumentation.count("failed", backend, delivery.notice_type)
+        else:
+            sent_ids.append(delivery.id)
+            instrumentation.count("deliver", backend, delivery.notice_type)
+    activate(current_language)
+    if sent_ids:
+        Delivery.objects.filter(id__in=sent_ids).update(status=Delivery.SENT,
+                                                        sent=timezone.now())
+    return len(sent_ids)
+
+
+def send_deliveries(medium=None, limit=None, chunk_size=None):
+    '''
+    Sends the due deliveries of the outbox, highest priority first and oldest
+    due first within a priority, optionally only those of one medium. Returns
+    the number of deliveries sent.
+    '''
+    chunk_size = chunk_size or OUTBOX_CHUNK_SIZE
+    # a replica that is behind would offer deliveries already sent
+    primary = router.db_for_write(Delivery, lookup=True)
+    sent = 0
+    handled = 0
+    chunks = 0
+    while limit is None or handled < limit:
+        now = timezone.now()
+        due = Delivery.objects.using(primary).filter(status=Delivery.PENDING, due__lte=now)
+        if medium is not None:
+            due = due.filter(medium=medium)
+        if fair_turn(chunks):
+            due = due.order_by("due")
+        else:
+            due = due.order_by("-priority", "due")
+        chunks += 1
+        size = chunk_size if limit is None else min(chunk_size, limit - handled)
+        candidates = list(due.select_related("recipient", "notice_type")[:size])
+        if not candidates:
+            break
+        lease_until = now + timedelta(seconds=OUTBOX_LEASE)
+        claimed = [d for d in candidates if claim(d, lease_until)]
+        handled += len(candidates)
+        if claimed:
+            sent += deliver_chunk(claimed)
+    return sent
+
+
+def lanes():
+    '''
+    Returns (medium, label, workers, chunk_size) for every backend the outbox
+    delivers to.
+    '''
+    result = []
+    for (medium_id, label), backend in sorted(NOTIFICATION_BACKENDS.items()):
+        if label == "website":
+            continue
+        lane = OUTBOX_LANES.get(label, {})
+        result.append((str(medium_id), label, lane.get("workers", 1),
+                       lane.get("chunk_size", OUTBOX_CHUNK_SIZE)))
+    return result
+
+
+def send_lanes(limit=None):
+    '''
+    Drains every lane in worker threads of its own, see NOTIFICATION_OUTBOX_LANES.
+    Each worker handles at most limit deliveries. Returns a dictionary of
+    backend label to number of deliveries sent.
+    '''
+    sent = {}
+    lock = threading.Lock()
+
+    def work(medium, label, chunk_size):
+        try:
+            count = send_deliveries(medium, limit, chunk_size)
+            with lock:
+                sent[label] = sent.get(label, 0) + count
+        except Exception:
+            logger.exception("outbox lane %s failed", label)
+        finally:
+            connection.close()
+
+    threads = []
+    for medium, label, workers, chunk_size in lanes():
+        sent[label] = 0
+        for i in xrange(workers):
+            thread = threading.Thread(target=work, args=(medium, label, chunk_size),
+                                      name="outbox-%s-%d" % (label, i))
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return sent
+
+
+def lane_stats():
+    '''
+    Returns a dictionary of backend label to the lane's number of pending,
+    due and dead deliveries, and lag: the seconds the oldest due delivery has
+    been waiting, or 0.
+    '''
+    now = timezone.now()
+    rows = Delivery.objects.order_by().values("medium", "status").annotate(count=Count("id"))
+    counts = dict(((row["medium"], row["status"]), row["count"]) for row in rows)
+    due = (Delivery.objects.order_by().filter(status=Delivery.PENDING, due__lte=now)
+                           .values("medium").annotate(count=Count("id"), oldest=Min("due")))
+    due = dict((row["medium"], row) for row in due)
+    stats = {}
+    for medium, label, workers, chunk_size in lanes():
+        lane_due = due.get(medium, {"count": 0, "oldest": None})
+        lag = 0
+        if lane_due["oldest"] is not None:
+            lag = max((now - lane_due["oldest"]).total_seconds(), 0)
+        stats[label] = {
+            "pending": counts.get((medium, Delivery.PENDING), 0),
+            "due": lane_due["count"],
+            "dead": counts.get((medium, Delivery.DEAD), 0),
+            "lag": lag,
+            "workers": workers,
+        }
+    return stats
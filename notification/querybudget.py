@@ -0,0 +1,253 @@
+'''
+Query budgets.
+
+Every public code path with a known database cost gets a Budget: the most
+queries it may run, as a function of the number of items it handles. The
+tests (notification.tests) and the check_query_budgets management command
+run each of them on synthetic data at two sizes, inside a transaction that is
+rolled back, and fail when one runs more queries than its budget allows.
+They show the queries whose count grew with the input, which is where a bulk
+path turned per row.
+
+The budgets hold for sizes below the number of rows the database takes in
+one bulk insert (about 250 with SQLite, which splits bigger ones), hence the
+small default sizes.
+
+Use QueryCounter to count queries around any other block of code:
+
+    with QueryCounter() as counter:
+        notification.send_now(users, "commented")
+    print len(counter)
+'''
+# Python Core
+import re
+from collections import defaultdict
+
+# Django
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+from django.test.client import Client
+
+# This app
+from notification import models as notification
+from notification.backends.website import Notice
+
+LABEL = 'query_budget_notice'
+PASSWORD = 'query-budget'
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter(object):
+    '''
+    Records the SQL run on the default database inside a with block, test
+    client requests included.
+    '''
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        # requests would empty connection.queries as they start
+        request_started.disconnect(reset_queries)
+        self.start = len(connection.queries)
+        self.queries = []
+        return self
+
+    def __exit__(self, *exc_info):
+        self.queries = [query['sql'] for query in connection.queries[self.start:]]
+        connection.use_debug_cursor = self.use_debug_cursor
+        request_started.connect(reset_queries)
+
+    def __len__(self):
+        return len(self.queries)
+
+
+class Budget(object):
+    '''
+    Allows constant + per_item * items + per_chunk * chunks queries, chunks
+    being the number of SEND_CHUNK_SIZE chunks the items are sent in.
+    '''
+
+    def __init__(self, constant, per_item=0, per_chunk=0):
+        self.constant = constant
+        self.per_item = per_item
+        self.per_chunk = per_chunk
+
+    def allowed(self, items):
+        chunks = -(-items // notification.SEND_CHUNK_SIZE)
+        return int(self.constant + self.per_item * items + self.per_chunk * chunks)
+
+    def __str__(self):
+        budget = '%d' % self.constant
+        if self.per_item:
+            budget += ' + %g/item' % self.per_item
+        if self.per_chunk:
+            budget += ' + %g/chunk' % self.per_chunk
+        return budget
+
+
+def normalize(sql):
+    '''
+    Returns sql with its literal values replaced, so the same query run for
+    different rows compares equal.
+    '''
+    return re.sub(r"'[^']*'|\b\d+\b", "?", sql)
+
+
+def query_diff(small, large):
+    '''
+    Returns lines for the normalized queries run more often for the large
+    input than for the small one, most grown first.
+    '''
+    counts = defaultdict(lambda: [0, 0])
+    for index, queries in enumerate((small, large)):
+        for sql in queries:
+            counts[normalize(sql)][index] += 1
+    grown = [(large_count - small_count, small_count, large_count, sql)
+             for sql, (small_count, large_count) in counts.items()
+             if large_count > small_count]
+    return ['%4d -> %-4d %s' % (small_count, large_count, sql)
+            for growth, small_count, large_count, sql in sorted(grown, reverse=True)]
+
+
+def create_users(prefix, count):
+    User.objects.bulk_create([User(username='%s%d' % (prefix, i),
+                                   email='%s%d@example.com' % (prefix, i))
+                              for i in xrange(count)])
+    return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+
+def logged_in(user):
+    user.set_password(PASSWORD)
+    user.save()
+    client = Client()
+    client.login(username=user.username, password=PASSWORD)
+    return client
+
+
+def observe_all(observer, observed_users, label=LABEL):
+    for observed in observed_users:
+        notification.observe(observed, observer, [label])
+
+
+# Each case prepares a run over size items. It returns the number of items
+# the budget is computed from and the function to count the queries of.
+
+def send_now_case(size):
+    # the recipients get their notice settings created on their first notice
+    users = create_users('budget_send_%d_' % size, size)
+    return size, lambda: notification.send_now(users, LABEL, sender=users[0])
+
+
+def send_now_queryset_case(size):
+    sender = create_users('budget_stream_%d_' % size, size)[0]
+    users = User.objects.filter(username__startswith='budget_stream_%d_' % size)
+    return size, lambda: notification.send_now(users, LABEL, sender=sender)
+
+
+def send_observation_notices_case(size):
+    users = create_users('budget_observer_%d_' % size, size)
+    observed = users[0]
+    for user in users:
+        notification.observe(observed, user, [LABEL])
+    return size, lambda: notification.send_observation_notices_for(observed, LABEL)
+
+
+def get_observations_case(size):
+    users = create_users('budget_observed_%d_' % size, size + 1)
+    observe_all(users[0], users[1:])
+    return size, lambda: notification.get_observations(users[0], User, [LABEL])
+
+
+def notice_settings_case(size):
+    for i in xrange(size):
+        notification.NoticeType.objects.create(label='budget_type_%d_%d' % (size, i),
+                                               display='Budget', description='budget',
+                                               default=2)
+    client = logged_in(create_users('budget_settings_%d_' % size, 1)[0])
+    items = notification.NoticeType.objects.count() * len(notification.NOTICE_MEDIA)
+    return items, lambda: client.get(reverse('notification_notice_settings'))
+
+
+def observation_settings_case(size):
+    users = create_users('budget_observation_settings_%d_' % size, size + 1)
+    observe_all(users[0], users[1:])
+    client = logged_in(users[0])
+    url = reverse('notificaton_observation_settings',
+                  args=[ContentType.objects.get_for_model(User).name])
+    return size, lambda: client.get(url)
+
+
+def toggle_all_case(size):
+    users = create_users('budget_toggle_%d_' % size, 2)
+    for i in xrange(size):
+        notification.send_now([users[0]], LABEL, sender=users[1])
+    client = logged_in(users[0])
+    data = dict(('%d-unseen' % notice_id, 'False') for notice_id in
+                Notice.objects.filter(recipient=users[0]).values_list('id', flat=True))
+    return size, lambda: client.post(reverse('notification_toggle_all'), data,
+                                     HTTP_REFERER='/')
+
+
+def unseen_count_case(size):
+    users = create_users('budget_unseen_%d_' % size, 2)
+    for i in xrange(size):
+        notification.send_now([users[0]], LABEL, sender=users[1])
+    return size, lambda: Notice.objects.unseen_count_for(users[0])
+
+
+# The website backend still inserts one notice per recipient.
+BUDGETS = [
+    ('send_now', send_now_case, Budget(4, 1, 5)),
+    ('send_now with a QuerySet', send_now_queryset_case, Budget(4, 1, 6)),
+    ('send_observation_notices_for', send_observation_notices_case, Budget(5, 1, 5)),
+    ('get_observations', get_observations_case, Budget(2)),
+    ('notice_settings view', notice_settings_case, Budget(7, 0, 1)),
+    ('observation_settings view', observation_settings_case, Budget(7)),
+    ('toggle_all view', toggle_all_case, Budget(5)),
+    ('unseen_count_for', unseen_count_case, Budget(1)),
+]
+
+
+def create_notice_type():
+    notification.NoticeType.objects.get_or_create(
+        label=LABEL, defaults={'display': 'Budget', 'description': 'has budgeted your user',
+                               'default': 2})
+
+
+def run_case(case, budget, sizes=(5, 10)):
+    '''
+    Runs case at each size. Returns [(items, queries, allowed)] per size and
+    the lines of the queries that grew between the smallest and the largest
+    size when the budget was exceeded, or an empty list.
+    '''
+    runs = []
+    queries = []
+    for size in sizes:
+        items, run = case(size)
+        with QueryCounter() as counter:
+            run()
+        runs.append((items, len(counter), budget.allowed(items)))
+        queries.append(counter.queries)
+    exceeded = any(count > allowed for items, count, allowed in runs)
+    return runs, query_diff(queries[0], queries[-1]) if exceeded else []
+
+
+def check_budgets(sizes=(5, 10), budgets=None):
+    '''
+    Runs every budgeted case at each size. Returns a list of (name, budget,
+    [(items, queries, allowed)], diff) tuples, see run_case. Must run inside
+    a transaction that is rolled back afterwards, the cases create their own
+    data.
+    '''
+    create_notice_type()
+    results = []
+    for name, case, budget in budgets or BUDGETS:
+        runs, diff = run_case(case, budget, sizes)
+        results.append((name, budget, runs, diff))
+    return results
@@ -0,0 +1,162 @@
+'''
+Retention policies for notices and processed queue batches.
+
+NOTIFICATION_RETENTION( = {}) configures what purge_notices deletes:
+    "archived": delete archived notices added more than this many days ago.
+    "seen": delete seen notices added more than this many days ago.
+    "per_user": keep at most this many notices per user, newest first.
+    "queue": delete queue batches processed more than this many days ago.
+    "outbox": delete outbox deliveries sent more than this many days ago.
+Missing or None entries are never purged. Shared notice and delivery payloads
+nothing points to anymore and expired idempotency keys are always deleted.
+
+Rows are deleted NOTIFICATION_PURGE_CHUNK_SIZE( = 1000) at a time, walking the
+primary key index, with a NOTIFICATION_PURGE_PAUSE( = 0.1) seconds pause
+between chunks, so the purge can run while the site is busy without long
+locks or replication lag.
+'''
+# Python Core
+import time
+from datetime import timedelta
+
+# Django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.sql.subqueries import DeleteQuery
+from django.utils import timezone
+
+# This app
+from notification.models import (NoticeQueueBatch, Delivery, DeliveryPayload,
+                                 IdempotencyKey, IDEMPOTENCY_TTL, stream)
+from notification.backends.website import Notice, NoticePayload, SEEN_WATERMARK
+
+RETENTION = getattr(settings, "NOTIFICATION_RETENTION", {})
+PURGE_CHUNK_SIZE = getattr(settings, "NOTIFICATION_PURGE_CHUNK_SIZE", 1000)
+PURGE_PAUSE = getattr(settings, "NOTIFICATION_PURGE_PAUSE", 0.1)
+
+
+def delete_ids(model, ids, using):
+    '''
+    Deletes rows by primary key with a single statement, without loading
+    them or sending delete signals, and commits.
+    '''
+    DeleteQuery(model).delete_batch(ids, using)
+    transaction.commit_unless_managed(using=using)
+
+
+def purge(queryset, chunk_size=None, pause=None):
+    '''
+    Deletes the rows of queryset in chunks, in primary key order. Returns the
+    number of rows deleted.
+    '''
+    chunk_size = chunk_size or PURGE_CHUNK_SIZE
+    pause = PURGE_PAUSE if pause is None else pause
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by("id")
+                           .values_list("id", flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        last_id = ids[-1]
+        delete_ids(queryset.model, ids, queryset.db)
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+
+
+def purge_user_overflow(limit, chunk_size=None, pause=None):
+    '''
+    Deletes the oldest notices of every user with more than limit notices.
+    Users are walked chunk_size at a time in primary key order, the notices
+    of each chunk counted on the recipient index.
+    '''
+    chunk_size = chunk_size or PURGE_CHUNK_SIZE
+    pause = PURGE_PAUSE if pause is None else pause
+    deleted = 0
+    user_ids = User.objects.values_list("id", flat=True)
+    for chunk in stream(user_ids, chunk_size, pk_of=lambda pk: pk):
+        # order_by() drops the default ordering, which would end up in the GROUP BY
+        crowded = list(Notice.objects.filter(recipient__in=chunk).order_by().values("recipient")
+                                     .annotate(notices=Count("id")).filter(notices__gt=limit)
+                                     .values_list("recipient", flat=True))
+        for recipient_id in crowded:
+            deleted += purge_recipient_overflow(recipient_id, limit, chunk_size, pause)
+    return deleted
+
+
+def purge_recipient_overflow(recipient_id, limit, chunk_size, pause):
+    '''
+    Deletes the notices of a user beyond their limit newest ones.
+    '''
+    deleted = 0
+    notices = Notice.objects.filter(recipient=recipient_id).order_by("-added", "-id")
+    while True:
+        ids = list(notices.values_list("id", flat=True)[limit:limit + chunk_size])
+        if not ids:
+            return deleted
+        delete_ids(Notice, ids, notices.db)
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+
+
+def purge_payloads(chunk_size=None, pause=None):
+    '''
+    Deletes the shared payloads of deleted notices and outbox deliveries.
+    Payloads younger than a day are left alone, their send may still be
+    creating notices.
+    '''
+    day_ago = timezone.now() - timedelta(days=1)
+    orphans = NoticePayload.objects.filter(notice__isnull=True, added__lt=day_ago)
+    delivery_orphans = DeliveryPayload.objects.filter(delivery__isnull=True, added__lt=day_ago)
+    return purge(orphans, chunk_size, pause) + purge(delivery_orphans, chunk_size, pause)
+
+
+def purge_idempotency_keys(chunk_size=None, pause=None):
+    '''
+    Deletes the idempotency keys older than NOTIFICATION_IDEMPOTENCY_TTL.
+    '''
+    keys = IdempotencyKey.objects.filter(added__lt=timezone.now() - timedelta(hours=IDEMPOTENCY_TTL))
+    return purge(keys, chunk_size, pause)
+
+
+def expired(policy, days):
+    '''
+    Returns the queryset of rows the policy may delete for a retention of
+    days, see NOTIFICATION_RETENTION.
+    '''
+    cutoff = timezone.now() - timedelta(days=days)
+    if policy == "archived":
+        return Notice.objects.filter(archived=True, added__lt=cutoff)
+    if policy == "seen":
+        seen = Notice.objects.filter(unseen=False, added__lt=cutoff)
+        if SEEN_WATERMARK:
+            below = Notice.objects.filter(added__lt=cutoff, keep_unseen=False,
+                                          added__lte=F("recipient__seenwatermark__seen_until"))
+            seen = seen | below
+        return seen
+    if policy == "queue":
+        return NoticeQueueBatch.objects.filter(processed__lt=cutoff)
+    if policy == "outbox":
+        return Delivery.objects.filter(status=Delivery.SENT, sent__lt=cutoff)
+    raise ValueError("unknown retention policy %s" % policy)
+
+
+def purge_all(retention=None, chunk_size=None, pause=None):
+    '''
+    Applies every configured retention policy. Returns a dictionary of policy
+    to number of rows deleted.
+    '''
+    retention = RETENTION if retention is None else retention
+    deleted = {}
+    for policy in ("archived", "seen", "queue", "outbox"):
+        if retention.get(policy) is not None:
+            deleted[policy] = purge(expired(policy, retention[policy]), chunk_size, pause)
+    if retention.get("per_user") is not None:
+        deleted["per_user"] = purge_user_overflow(retention["per_user"], chunk_size, pause)
+    deleted["payloads"] = purge_payloads(chunk_size, pause)
+    deleted["idempotency_keys"] = purge_idempotency_keys(chunk_size, pause)
+    return deleted
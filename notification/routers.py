@@ -0,0 +1,94 @@
+'''
+Read replica routing for the notification models.
+
+Add the router and the middleware to the settings and list the replicas:
+
+    DATABASE_ROUTERS = ["notification.routers.ReplicaRouter"]
+    MIDDLEWARE_CLASSES += ("notification.middleware.PrimaryStickinessMiddleware",)
+    NOTIFICATION_REPLICAS = ["replica1", "replica2"]
+
+Reads of notification models go to a random replica and writes to
+NOTIFICATION_PRIMARY. A thread that wrote reads from the primary until it is
+unpinned, so it sees its own writes: the middleware unpins at the start of
+every request, and keeps a user who wrote on the primary for
+NOTIFICATION_PRIMARY_STICKY seconds with a cookie, so the pages after their
+own changes are not read from a replica that is behind. Workers, which are
+never unpinned, read from the primary once they wrote; their locking and
+claiming reads always go to the primary with
+
+    queryset.using(router.db_for_write(Model, lookup=True))
+
+The lookup hint only asks where Model is written: it neither pins the
+thread nor counts as a write.
+
+Other apps are not routed; with no replicas everything stays on the primary.
+'''
+# Python Core
+import random
+import threading
+
+# Django
+from django.conf import settings
+
+REPLICAS = getattr(settings, "NOTIFICATION_REPLICAS", [])
+PRIMARY = getattr(settings, "NOTIFICATION_PRIMARY", "default")
+# seconds a user's reads stay on the primary after they wrote
+PRIMARY_STICKY = getattr(settings, "NOTIFICATION_PRIMARY_STICKY", 5)
+
+_locals = threading.local()
+
+
+def pin_to_primary():
+    '''
+    Sends the reads of the current thread to the primary.
+    '''
+    _locals.pinned = True
+
+
+def unpin():
+    _locals.pinned = False
+    _locals.wrote = False
+
+
+def is_pinned():
+    return getattr(_locals, "pinned", False)
+
+
+def has_written():
+    '''
+    True when the current thread wrote a notification model since it was
+    last unpinned.
+    '''
+    return getattr(_locals, "wrote", False)
+
+
+class ReplicaRouter(object):
+
+    def routed(self, model):
+        return model._meta.app_label == "notification"
+
+    def db_for_read(self, model, **hints):
+        if not self.routed(model):
+            return None
+        if not REPLICAS or is_pinned():
+            return PRIMARY
+        return random.choice(REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        if not self.routed(model):
+            return None
+        if not hints.get("lookup"):
+            _locals.wrote = True
+            pin_to_primary()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [PRIMARY] + list(REPLICAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if not self.routed(model):
+            return None
+        return db == PRIMARY
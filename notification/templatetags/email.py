@@ -6,18 +6,30 @@ from urllib import quote
 import socket
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 import re
 
 register = Library()
 
+# root_url and dev_static_prefix are computed once per process so rendering
+# an email does no Site or DNS lookups. root_url is forgotten whenever a Site
+# is saved or deleted.
+url_cache = {}
+
+@receiver([post_save, post_delete], sender=Site)
+def clear_root_url(sender, **kwargs):
+    url_cache.pop('root_url', None)
+
 @register.assignment_tag
 def root_url():
     '''
     Provide root url for current site.
     '''
-    current_site = Site.objects.get_current()
-    root_url = "http://%s" % unicode(current_site)
-    return root_url
+    if 'root_url' not in url_cache:
+        current_site = Site.objects.get_current()
+        url_cache['root_url'] = "http://%s" % unicode(current_site)
+    return url_cache['root_url']
 
 @register.assignment_tag
 def dev_static_prefix():
@@ -26,6 +38,8 @@ def dev_static_prefix():
     static file email links to work.  Rturns '' when in production.  Prfix all relative
     url's with {{DEV_STATE_PREFIX}} in templates to get full url's in emails.
     '''
+    if 'static_prefix' in url_cache:
+        return url_cache['static_prefix']
     try:
         static_url = getattr(settings, 'STATIC_URL')
         debug = getattr(settings, 'DEBUG')
@@ -38,10 +52,11 @@ def dev_static_prefix():
     else:
         try:
             host_ip = socket.gethostbyname(socket.gethostname())
-        except:
-            host_ip = localhost
+        except socket.error:
+            host_ip = 'localhost'
         port = getattr(settings, 'EMAIL_STATIC_HOST_PORT', '8000')
         static_prefix = 'http://'+host_ip+':'+port
+    url_cache['static_prefix'] = static_prefix
     return static_prefix
 
 @register.inclusion_tag('email/templatetags/email_header_generic.html', takes_context=True)
@@ -53,6 +68,102 @@ def footer_generic(context, request):
     return context 
 
 #notice template tags
+class LinkRewriter(object):
+    '''
+    Converts key words in notice descriptions to hyperlinks for make_link and
+    sender_to_link. Built once from the settings, the key words of
+    NOTIFICATION_OTHER_KEY_WORDS are matched with a single regular expression
+    and rewritten in one pass over the description.
+    '''
+    def __init__(self):
+        self.key_word_map = getattr(settings, 'KEY_WORD_TO_URL_TRANSLATIONS', {})
+        self.type_map = getattr(settings, 'NOTIFICATION_CONTENT_TYPE_TRANSLATIONS', {})
+        self.sender_names = getattr(settings, 'NOTIFICATION_CHECK_FOR_SENDER_NAMES', {})
+        self.other_key_words = getattr(settings, 'NOTIFICATION_OTHER_KEY_WORDS', {})
+        self.type_names = {}
+        self.rewrite_res = {}
+        # key words are tried in settings order, so the first one wins where
+        # two of them overlap, like it did when they were replaced one by one
+        self.key_words = list(self.other_key_words)
+        if self.key_words:
+            alternation = '|'.join(re.escape(key_word) for key_word in self.key_words)
+            #find the word only if it's not part of another word
+            self.standalone_re = re.compile(r'\s(' + alternation + r')(?=\W|$)')
+        else:
+            self.standalone_re = None
+
+    def type_name(self, sender):
+        model = sender.__class__
+        if model not in self.type_names:
+            self.type_names[model] = ContentType.objects.get_for_model(sender).name
+        return self.type_names[model]
+
+    def rewrite_re(self, key_words):
+        '''
+        Returns the expression replacing the given key words, compiled once for
+        each set of key words found in descriptions.
+        '''
+        if key_words not in self.rewrite_res:
+            self.rewrite_res[key_words] = re.compile('|'.join(
+                re.escape(key_word) for key_word in self.key_words
+                if key_word in key_words))
+        return self.rewrite_res[key_words]
+
+    def key_word_to_url(self, desc, key_word, url):
+        key_word = self.key_word_map.get(key_word, key_word)
+        if str(key_word) in str(desc):
+            link = '<a href="'+url+'">'+key_word.title()+'</a>'
+            desc = link.join(desc.split(key_word))
+        return desc
+
+    def sender_to_link(self, desc, sender, url, allnames=None):
+        try:
+            sender_type = self.type_name(sender)
+            desc = str(desc)
+
+            #check for translations
+            sender_map = self.type_map.get(sender_type, [None,None])
+            path = sender_map[1] or ''
+            if path: url = url+path+str(sender.id)+'/'
+            sender_type = sender_map[0] or sender_type
+
+            #check for sender_type
+            if sender_type in desc:
+                link = '<a href="'+url+'">'+sender_type.title()+'</a>'
+                desc = link.join(desc.split(sender_type))
+
+            #also check for the sender's name if allnames=True or if sender_type in sender_names
+            if allnames or allnames == None and sender_type in self.sender_names:
+                type = self.sender_names.get(sender_type, ['self','/'+sender_type+'/'])
+                url_path = type[1]
+                name_property = type[0] or 'self'
+                sender_name_obj = getattr(sender, name_property, sender)
+                sender_name = str(sender_name_obj)
+                #set up id for url
+                id = str(getattr(sender_name_obj,'id', ''))
+                if id: id = id+'/'
+                if sender_name.lower() in desc.lower():
+                    link = '<a href="'+url_path+id+'">'+sender_name.title()+'</a>'
+                    rex = re.escape(sender_name.lower())+'|'+re.escape(sender_name.title())
+                    desc = re.sub(rex, lambda found: link, desc)
+        except:
+            sender_type = None
+        return self.key_words_to_links(desc, sender, sender_type)
+
+    def key_words_to_links(self, desc, sender, skip=None):
+        if self.standalone_re is None:
+            return desc
+        found = frozenset(match.group(1) for match in self.standalone_re.finditer(desc))
+        found = found - set([skip])
+        if not found:
+            return desc
+        sender_id = str(sender.id)
+        links = dict((key_word, '<a href="'+self.other_key_words[key_word]+sender_id+'/">'+key_word.title()+'</a>')
+                     for key_word in found)
+        return self.rewrite_re(found).sub(lambda match: links[match.group(0)], desc)
+
+link_rewriter = LinkRewriter()
+
 @register.simple_tag(name='make_link')
 def key_word_to_url(desc, key_word, url):
     '''
@@ -63,14 +174,8 @@ def key_word_to_url(desc, key_word, url):
     IE: if your key_word variable is content_type, in this example user is the 
     content_type and your desc refers to users as "blogger" {'user':'blogger'}
     '''
-    map = getattr(settings, 'KEY_WORD_TO_URL_TRANSLATIONS', {})
-    key_word = map.get(key_word, key_word)
-    if str(key_word) in str(desc):
-        link = '<a href="'+url+'">'+key_word.title()+'</a>'
-        desc = link.join(desc.split(key_word))
+    return link_rewriter.key_word_to_url(desc, key_word, url)
 
-    return desc
-    
 @register.simple_tag(name='sender_to_link')
 def sender_to_link(desc, sender, url, observed=None, allnames=None):
     '''
@@ -97,55 +202,7 @@ def sender_to_link(desc, sender, url, observed=None, allnames=None):
       If you want to seach for sender.user sepcify 'user'.
     - url output: path to the name object's id '/url_path/name_obj.id/'
     '''
-    map = getattr(settings, 'NOTIFICATION_CONTENT_TYPE_TRANSLATIONS', {})
-    sender_names = getattr(settings, 'NOTIFICATION_CHECK_FOR_SENDER_NAMES', {})
-    other_key_words = getattr(settings, 'NOTIFICATION_OTHER_KEY_WORDS', {})
-    try:
-        sender_type = ContentType.objects.get_for_model(sender).name
-        desc = str(desc)
-        
-        #check for translations
-        sender_map = map.get(sender_type, [None,None])
-        path = sender_map[1] or ''
-        if path: url = url+path+str(sender.id)+'/'
-        sender_type = sender_map[0] or sender_type
-
-        #check for sender_type
-        if sender_type in desc:
-            link = '<a href="'+url+'">'+sender_type.title()+'</a>'
-            desc = link.join(desc.split(sender_type))
-        
-        #also check for the sender's name if allnames=True or if sender_type in sender_names
-        if allnames and sender_type not in sender_names:
-            #add current sender name to list
-            sender_names.update({sender_type:['self','/'+sender_type+'/']})
-        if allnames or allnames == None and sender_type in sender_names:
-            type = sender_names[sender_type]
-            url_path = type[1]
-            name_property = type[0] or 'self'
-            sender_name_obj = getattr(sender, name_property, sender)
-            sender_name = str(sender_name_obj)
-            #set up id for url
-            id = str(getattr(sender_name_obj,'id', ''))
-            if id: id = id+'/'
-            if sender_name.lower() in desc.lower():
-                link = '<a href="'+url_path+id+'">'+sender_name.title()+'</a>'
-                desc = link.join(desc.split(sender_name.lower()))
-                desc = link.join(desc.split(sender_name.title()))
-    except:
-        sender_type = None           
-    #also check for other key words
-    for key_word in other_key_words:
-        if key_word != sender_type:
-            #find the word only if it's not part of another word
-            rex = r'\s('+key_word+')[\s\W]+|\s('+key_word+')$'
-            found = re.search(rex,desc)
-            if found:
-                result = found.group(1) or found.group(2)
-                link = '<a href="'+other_key_words[key_word]+str(sender.id)+'/">'+key_word.title()+'</a>'
-                desc = link.join(desc.split(result))
-
-    return desc
+    return link_rewriter.sender_to_link(desc, sender, url, allnames)
 
 @register.assignment_tag(name='observed_desc')
 def convert_to_observed_description(desc, sender_type, from_user, owner):
@@ -0,0 +1,53 @@
+'''
+Query budgets of the public functions and views, see notification.querybudget.
+'''
+# Python Core
+from StringIO import StringIO
+import os
+import sys
+
+# Django
+from django.test import TestCase
+from django.test.utils import override_settings
+
+# This app
+from notification.querybudget import BUDGETS, create_notice_type, run_case
+
+# Minimal notice, email and account/base.html templates, so the tests neither
+# depend on the project's templates nor on its static files.
+TEMPLATE_DIRS = (os.path.join(os.path.dirname(__file__), 'test_templates'),)
+TEMPLATE_LOADERS = ('django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader')
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                   TEMPLATE_DIRS=TEMPLATE_DIRS, TEMPLATE_LOADERS=TEMPLATE_LOADERS)
+class QueryBudgetTest(TestCase):
+
+    sizes = (5, 10)
+
+    def setUp(self):
+        create_notice_type()
+        # the code under test prints
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def assertWithinBudget(self, case, budget):
+        runs, diff = run_case(case, budget, self.sizes)
+        if diff:
+            self.fail('over budget %s: %s\nqueries grown from %d to %d items:\n%s' % (
+                budget, ', '.join('%d items: %d/%d' % run for run in runs),
+                runs[0][0], runs[-1][0], '\n'.join(diff)))
+
+
+def budget_test(case, budget):
+    def test(self):
+        self.assertWithinBudget(case, budget)
+    test.__doc__ = '%s runs at most %s queries' % (case.__name__[:-len('_case')], budget)
+    return test
+
+for name, case, budget in BUDGETS:
+    setattr(QueryBudgetTest, 'test_%s' % case.__name__[:-len('_case')], budget_test(case, budget))
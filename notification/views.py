@@ -17,9 +17,10 @@ from django.contrib.auth.decorators import login_required
 
 # This app
 #FIXME dinamically import this
-from notification.backends.website import Notice
+from notification.backends.website import Notice, SEEN_WATERMARK
 from notification.models import (NoticeType, NoticeSetting, NOTICE_MEDIA,
-                                 get_notification_setting)
+                                 get_notification_settings, get_muted_media,
+                                 mute, unmute)
 
 @login_required
 def notices(request, alln=False, archived=False):
@@ -37,7 +38,7 @@ def notices(request, alln=False, archived=False):
 
     if not alln:
         old = datetime.now() - timedelta(days=3)
-        latest_notices = notices.filter(Q(unseen=True) |
+        latest_notices = notices.filter(Notice.objects.unseen_q(request.user) |
                                         Q(added__gt=old))
 
         if len(latest_notices) < 10:
@@ -75,32 +76,46 @@ def notice_settings(request):
             value is ``True`` or ``False`` depending on a ``request.POST``
             variable called ``form_label``, whose valid value is ``on``.
     """
-    notice_types = NoticeType.objects.all()
+    notice_types = list(NoticeType.objects.all())
+    user_settings = get_notification_settings([request.user], notice_types)
     settings_table = []
-    changed = False
+    to_send = {True: [], False: []}
+    # muted media show unchecked; checking any of their boxes unmutes them.
+    # The boxes of a medium that stays muted are not compared, so saving the
+    # form keeps the settings it had before it was muted.
+    muted = set(medium for user_id, medium in get_muted_media([request.user]))
+    unmuted = set()
+    if request.method == "POST":
+        unmuted = set(medium_id for medium_id, medium_display in NOTICE_MEDIA
+                      if unicode(medium_id) in muted and any(
+                          request.POST.get("%s_%s" % (notice_type.label, medium_id)) == "on"
+                          for notice_type in notice_types))
     for notice_type in notice_types:
         settings_row = []
         for medium_id, medium_display in NOTICE_MEDIA:
             form_label = "%s_%s" % (notice_type.label, medium_id)
-            setting = get_notification_setting(request.user,
-                                               notice_type,
-                                               medium_id)
-            if request.method == "POST":
-                if request.POST.get(form_label) == "on":
-                    if not setting.send:
-                        setting.send = True
-                        setting.save()
-                        changed = True
-                else:
-                    if setting.send:
-                        setting.send = False
-                        setting.save()
-                        changed = True
-            settings_row.append((form_label, setting.send))
+            setting = user_settings[(request.user.id, notice_type.id, unicode(medium_id))]
+            if request.method == "POST" and (unicode(medium_id) not in muted
+                                             or medium_id in unmuted):
+                send = request.POST.get(form_label) == "on"
+                if send != setting.send:
+                    setting.send = send
+                    to_send[send].append(setting.id)
+            settings_row.append((form_label, setting.send and unicode(medium_id) not in muted))
         #use to determin if a notice_type is from the system or a system user
         notice_type.is_system = notice_type.label.find('system')+1
         settings_table.append({"notice_type": notice_type, "cells": settings_row})
 
+    # one UPDATE per value for the changed checkboxes
+    changed = False
+    for send, ids in to_send.items():
+        if ids:
+            NoticeSetting.objects.filter(id__in=ids).update(send=send)
+            changed = True
+    if unmuted:
+        unmute(request.user, unmuted)
+        changed = True
+
     if changed:
         messages.add_message(request, messages.INFO, "Notification settings updated.")
 
@@ -140,8 +155,7 @@ def single(request, id, mark_seen=True):
     notice = get_object_or_404(Notice, id=id)
     if request.user == notice.recipient:
         if mark_seen and notice.unseen:
-            notice.unseen = False
-            notice.save()
+            notice.set_unseen(False)
         return render_to_response("notification/single.html", {
             "notice": notice,
         }, context_instance=RequestContext(request))
@@ -167,8 +181,7 @@ def view_sender(request, id, sender_url=None, mark_seen=True):
     notice = get_object_or_404(Notice, id=id)
     if request.user == notice.recipient:
         if mark_seen and notice.unseen:
-            notice.unseen = False
-            notice.save()
+            notice.set_unseen(False)
         if not sender_url:
             sender_url = request.REQUEST.get('sender_url',None)
             try:
@@ -276,12 +289,7 @@ def toggle_unseen(request, noticeid=None, next_page=None):
         try:
             notice = Notice.objects.get(id=noticeid)
             if request.user == notice.recipient or request.user.is_superuser:
-                if notice.unseen:
-                    notice.unseen = False
-                    notice.save()
-                else:
-                    notice.unseen = True
-                    notice.save()
+                notice.set_unseen(not notice.unseen)
             else:   # you can delete other users' notices
                     # only if you are superuser.
                 return HttpResponseRedirect(next_page)
@@ -317,25 +325,36 @@ def toggle_all(request, next_page=None):
                 notices[id] = {action:value}
             else:
                notices[id].update({action:value})
-    for notice_id in notices:
-        try:
-            notice = Notice.objects.get(id=notice_id)
-            if request.user == notice.recipient or request.user.is_superuser:
-                if notices[notice_id].get('unseen', None) != None and notice.unseen != notices[notice_id]['unseen']:
-                    notice.unseen = notices[notice_id]['unseen']
-                    notice.save()
-                if notices[notice_id].get('archived', None) != None and notice.archived != notices[notice_id]['archived']:
-                    notice.archived = notices[notice_id]['archived']
-                    notice.save()
-                if notices[notice_id].get('delete', None) != None and notices[notice_id]['delete']:
-                    notice.delete()
-                
-            else:   # you can delete other users' notices
-                    # only if you are superuser.
-                return HttpResponseRedirect(next_page)
-        except Notice.DoesNotExist:
+    found = list(Notice.objects.filter(id__in=notices.keys()))
+    if len(found) != len(notices):
+        return HttpResponseRedirect(next_page)
+    for notice in found:
+        # you can change other users' notices only if you are superuser.
+        if request.user.id != notice.recipient_id and not request.user.is_superuser:
             return HttpResponseRedirect(next_page)
 
+    # one UPDATE per changed field and value, one DELETE for all
+    unseen = {True: [], False: []}
+    archived = {True: [], False: []}
+    deleted = []
+    for notice in found:
+        actions = notices[str(notice.id)]
+        if actions.get('unseen', None) != None and notice.unseen != actions['unseen']:
+            unseen[bool(actions['unseen'])].append(notice.id)
+        if actions.get('archived', None) != None and notice.archived != actions['archived']:
+            archived[bool(actions['archived'])].append(notice.id)
+        if actions.get('delete', None) != None and actions['delete']:
+            deleted.append(notice.id)
+    for value, ids in unseen.items():
+        if ids:
+            Notice.objects.filter(id__in=ids).update(
+                unseen=value, keep_unseen=bool(value and SEEN_WATERMARK))
+    for value, ids in archived.items():
+        if ids:
+            Notice.objects.filter(id__in=ids).update(archived=value)
+    if deleted:
+        Notice.objects.filter(id__in=deleted).delete()
+
     return HttpResponseRedirect(next_page)
 
 
@@ -346,9 +365,7 @@ def mark_all_seen(request):
     ``HttpResponseRedirect`` when complete. 
     """
 
-    for notice in Notice.objects.notices_for(request.user, unseen=True):
-        notice.unseen = False
-        notice.save()
+    Notice.objects.mark_all_seen(request.user)
     return HttpResponseRedirect(request.META['HTTP_REFERER'])
 
 
@@ -360,13 +377,15 @@ def unsubscribe(request, medium, code):
     except (BadSignature, User.DoesNotExist, IndexError):
         raise Http404
 
-    for ns in NoticeSetting.objects.filter(user=user, medium=medium_code):
-        ns.send = False
-        ns.save()
+    mute(user, medium_code)
 
+    ctx = {}
     if medium == 'email':
         ctx = {'message': """Your email address (%s) will no longer receive any
                           other email notification from us.""" % user.email}
+    elif medium == 'digest':
+        ctx = {'message': """Your email address (%s) will no longer receive any
+                          other notification digest from us.""" % user.email}
 
     return render(request, 'notification/unsubscribed.html', ctx)
 
@@ -397,38 +416,47 @@ def observation_settings(request, content_type_name=None):
         observations = Observation.objects.filter(user=request.user, content_type=content_type).order_by('object_id')
     else:
         observations = Observation.objects.filter(user=request.user).order_by('content_type', '-object_id')
-    notice_types_u = [x[0] for x in set(observations.values_list('notice_type'))]
-    notice_types = NoticeType.objects.filter(id__in=notice_types_u)
-    observations_u = set(observations.values_list('content_type', 'user', 'object_id'))
-    observer = request.user
-    
+    observations = list(observations.select_related('content_type')
+                                    .prefetch_related('observed_object'))
+    notice_types = list(NoticeType.objects.filter(
+        id__in=set(observation.notice_type_id for observation in observations)))
+
+    # the observations of each observed object, by notice type
+    observed_order = []
+    observed_sets = {}
+    for observation in observations:
+        key = (observation.content_type_id, observation.user_id, observation.object_id)
+        if key not in observed_sets:
+            observed_order.append(key)
+            observed_sets[key] = {}
+        observed_sets[key].setdefault(observation.notice_type_id, observation)
+
     settings_table = []
-    changed = False
+    to_send = {True: [], False: []}
 
-    for observed in observations_u:
+    for key in observed_order:
         settings_row = []
-        observed_set = observations.filter(content_type=observed[0], user=observed[1], object_id=observed[2])
+        observed_set = observed_sets[key]
         for notice_type in notice_types:
-            try:
-                qs = observed_set.filter(notice_type=notice_type)
-                observed_obj = qs[0]
-                form_label = "%s_%s" % (notice_type.label, observed_obj.id)
-                send = observed_obj.send
-                if request.method == "POST":
-                    if request.POST.get(form_label) == "on":
-                        if not send:
-                            observed_obj.send = True
-                            changed = True
-                            observed_obj.save()
-                    else:
-                        if send:
-                            observed_obj.send = False
-                            changed = True
-                            observed_obj.save()
-                settings_row.append((form_label, observed_obj.send, notice_type.display))
-            except:
+            observed_obj = observed_set.get(notice_type.id)
+            if observed_obj is None:
                 settings_row.append((False, False))
-        settings_table.append({"observed": observed_obj, "cells": settings_row})
+                continue
+            form_label = "%s_%s" % (notice_type.label, observed_obj.id)
+            if request.method == "POST":
+                send = request.POST.get(form_label) == "on"
+                if send != observed_obj.send:
+                    observed_obj.send = send
+                    to_send[send].append(observed_obj.id)
+            settings_row.append((form_label, observed_obj.send, notice_type.display))
+        settings_table.append({"observed": observed_set.values()[0], "cells": settings_row})
+
+    # one UPDATE per value for the changed checkboxes
+    changed = False
+    for send, ids in to_send.items():
+        if ids:
+            Observation.objects.filter(id__in=ids).update(send=send)
+            changed = True
 
     if changed:
         messages.add_message(request, messages.INFO, "Notification settings updated.")
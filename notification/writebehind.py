@@ -0,0 +1,123 @@
+'''
+Write-behind buffer for website notices.
+
+With NOTIFICATION_WRITE_BEHIND = True send_now does not insert its website
+notices one by one. Once the chunk of recipients they belong to is
+committed it adds them to a buffer of the process, which a background thread
+saves with bulk_create every NOTIFICATION_WRITE_BEHIND_INTERVAL milliseconds,
+or as soon as it holds NOTIFICATION_WRITE_BEHIND_SIZE notices. The buffer is
+flushed again when the process exits.
+
+A send_now within a transaction managed by its caller saves its notices
+right away: they could point to rows the buffer thread does not see yet, and
+they must go away if the caller rolls back.
+
+Buffered notices have no id yet, so the other backends of the send get the
+context of a send without a website notice: their links go to the sender
+directly rather than through view_sender. Notices still in the buffer are
+lost if the process is killed.
+'''
+# Python Core
+import atexit
+import logging
+import threading
+
+# Django
+from django.conf import settings
+from django.db import transaction
+
+WRITE_BEHIND = getattr(settings, "NOTIFICATION_WRITE_BEHIND", False)
+WRITE_BEHIND_INTERVAL = getattr(settings, "NOTIFICATION_WRITE_BEHIND_INTERVAL", 200)
+WRITE_BEHIND_SIZE = getattr(settings, "NOTIFICATION_WRITE_BEHIND_SIZE", 500)
+
+logger = logging.getLogger(__name__)
+
+
+class NoticeBuffer(object):
+    '''
+    Notices waiting to be saved, and the thread saving them.
+    '''
+
+    def __init__(self, interval=None, size=None):
+        self.interval = (interval or WRITE_BEHIND_INTERVAL) / 1000.0
+        self.size = size or WRITE_BEHIND_SIZE
+        self.notices = []
+        self.condition = threading.Condition()
+        # serializes the flushes of the thread and of the callers
+        self.flushing = threading.Lock()
+        self.thread = None
+        self.stopped = False
+
+    def add(self, notices):
+        '''
+        Adds committed notices: their recipients, senders and payloads must
+        be visible to other connections.
+        '''
+        with self.condition:
+            self.notices.extend(notices)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,
+                                               name="notification-write-behind")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            if len(self.notices) >= self.size:
+                self.condition.notify()
+
+    def __len__(self):
+        return len(self.notices)
+
+    def run(self):
+        while not self.stopped:
+            with self.condition:
+                if len(self.notices) < self.size:
+                    self.condition.wait(self.interval)
+                if self.stopped:
+                    return
+            self.flush()
+
+    def stop(self):
+        '''
+        Stops the thread and saves what is left, when the process exits.
+        '''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(self.interval)
+        self.flush()
+
+    def flush(self):
+        '''
+        Saves the buffered notices. Returns the number of notices saved.
+        '''
+        with self.flushing:
+            with self.condition:
+                notices, self.notices = self.notices, []
+            if not notices:
+                return 0
+            # imported here, the website backend imports this module
+            from notification.backends.website import Notice
+            try:
+                Notice.objects.bulk_create(notices)
+                return len(notices)
+            except Exception:
+                logger.exception("saving %d buffered notices failed, saving them one by one",
+                                 len(notices))
+            # only the notices that fail again are lost
+            saved = 0
+            for notice in notices:
+                try:
+                    with transaction.commit_on_success():
+                        notice.save(force_insert=True)
+                    saved += 1
+                except Exception:
+                    logger.exception("saving the buffered notice to user %s failed",
+                                     notice.recipient_id)
+            return saved
+
+buffer = NoticeBuffer()
+
+
+@atexit.register
+def stop():
+    buffer.stop()